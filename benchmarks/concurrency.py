@@ -0,0 +1,130 @@
+"""Stress test: concurrent cookbot runs on one host, with recipe locks.
+
+Usage::
+
+    python benchmarks/concurrency.py [--runs=N] [--machines=N]
+                                     [--components=N] [--duration=SECONDS]
+                                     [--no-locks]
+
+Generates a configuration with several machines of several components, each
+command sleeping ``--duration`` seconds. Then launches ``--runs`` concurrent
+``cookbot update`` processes at once, each one selecting a machine. Runs are
+spread over machines, so that some runs share machines (they wait for each
+other) and others do not (they proceed concurrently).
+
+Reports throughput and time spent waiting for locks, see
+:py:mod:`novapost.cookbot.locks`.
+
+"""
+import json
+from optparse import OptionParser, SUPPRESS_HELP
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from novapost.cookbot.command import Command
+from novapost.cookbot.recipes import Recipe
+
+
+class SleepRecipe(Recipe):
+    """Recipe whose update sleeps for "duration" option seconds."""
+    __slots__ = ()
+
+    def update(self):
+        time.sleep(float(self.options.get('duration', 0)))
+
+
+def generate_configuration(machines, components, duration):
+    """Return configuration of machines with components."""
+    lines = ['[DEFAULT]',
+             'recipe = __main__:SleepRecipe',
+             'duration = %s' % duration,
+             '',
+             '[main]',
+             'duration = 0',
+             'parts =']
+    lines.extend('    machine-%d' % machine for machine in range(machines))
+    for machine in range(machines):
+        lines.extend(['', '[machine-%d]' % machine, 'parts ='])
+        lines.extend('    component-%d' % component
+                     for component in range(components))
+    for component in range(components):
+        lines.extend(['', '[component-%d]' % component])
+    return '\n'.join(lines) + '\n'
+
+
+def child(arguments):
+    """Run cookbot in this process, print lock statistics as JSON."""
+    command = Command()
+    command.parse_shell_args(arguments)
+    context = command.get_context()
+    try:
+        command.run(context)
+    finally:
+        command.close_context(context)
+    locks = context.get('locks')
+    stats = locks.stats() if locks is not None else {}
+    sys.stdout.write(json.dumps(stats))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--runs', type='int', default=8)
+    parser.add_option('--machines', type='int', default=4)
+    parser.add_option('--components', type='int', default=5)
+    parser.add_option('--duration', type='float', default=0.05)
+    parser.add_option('--no-locks', action='store_true', default=False)
+    parser.add_option('--child', action='store_true', default=False,
+                      help=SUPPRESS_HELP)
+    (options, arguments) = parser.parse_args()
+    if options.child:
+        return child(arguments)
+    directory = tempfile.mkdtemp()
+    try:
+        configuration = os.path.join(directory, 'cookbot.cfg')
+        with open(configuration, 'w') as configuration_file:
+            configuration_file.write(generate_configuration(
+                options.machines, options.components, options.duration))
+        processes = []
+        start = time.time()
+        for run in range(options.runs):
+            arguments = [sys.executable, os.path.abspath(__file__), '--child',
+                         '--', '-c', configuration,
+                         '--select', 'machine-%d' % (run % options.machines)]
+            if not options.no_locks:
+                arguments.extend(['--lock-dir',
+                                  os.path.join(directory, 'locks')])
+            arguments.append('update')
+            processes.append(subprocess.Popen(arguments,
+                                              stdout=subprocess.PIPE))
+        outputs = [process.communicate()[0] for process in processes]
+        duration = time.time() - start
+        if any(process.returncode for process in processes):
+            sys.exit('Some runs failed.')
+        results = [json.loads(output) for output in outputs]
+    finally:
+        shutil.rmtree(directory)
+    commands = options.runs * (options.components + 1)
+    serialized = commands * options.duration
+    sys.stdout.write('%d runs, %d commands in %.2fs: %.1f runs/s, '
+                     '%.1f commands/s (fully serialized: >= %.2fs).\n'
+                     % (options.runs, commands, duration,
+                        options.runs / duration, commands / duration,
+                        serialized))
+    if options.no_locks:
+        return
+    acquisitions = sum(result['acquisitions'] for result in results)
+    contentions = sum(result['contentions'] for result in results)
+    wait_total = sum(result['wait_total'] for result in results)
+    wait_max = max([result['wait_max'] for result in results] or [0.])
+    sys.stdout.write('Locks: %d acquisitions, %d waited, total wait %.2fs, '
+                     'mean wait %.4fs, max wait %.2fs.\n'
+                     % (acquisitions, contentions, wait_total,
+                        wait_total / (acquisitions or 1), wait_max))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Memory benchmark: build a tree of ~100k recipes from configuration.
+
+Usage::
+
+    python benchmarks/memory.py [--environments=N] [--machines=N]
+                                [--components=N]
+
+Each variant runs in a subprocess, so that peak memory measurements do not
+interfere:
+
+* ``compact``: :py:class:`novapost.cookbot.recipes.Recipe`, i.e. slots,
+  shared command table and shared options.
+
+* ``dict``: a recipe class which restores the former layout, i.e. an
+  instance ``__dict__``, a per-instance command table and per-instance
+  options.
+
+"""
+from cStringIO import StringIO
+from optparse import OptionParser
+import resource
+import subprocess
+import sys
+import time
+
+from novapost.cookbot.recipes import Recipe
+from novapost.cookbot.settings import ConfigParserReader
+
+
+VARIANTS = {
+    'compact': 'novapost.cookbot.recipes:Recipe',
+    'dict': '__main__:DictRecipe',
+}
+
+
+class DictRecipe(Recipe):
+    """Recipe with an instance dictionary and private tables."""
+    def __init__(self, context, name, options):
+        super(DictRecipe, self).__init__(context, name, dict(options))
+        self.exposed_commands = dict(self.default_exposed_commands)
+
+
+def generate_configuration(environments, machines, components, factory):
+    """Return configuration of environments * machines * components recipes.
+
+    Components are shared by machines, as in real-world configurations.
+
+    """
+    lines = ['[main]', 'parts =']
+    lines.extend('    env-%d' % env for env in range(environments))
+    for env in range(environments):
+        lines.extend(['[env-%d]' % env, 'parts ='])
+        lines.extend('    machine-%d-%d' % (env, machine)
+                     for machine in range(machines))
+        for machine in range(machines):
+            lines.extend(['[machine-%d-%d]' % (env, machine), 'parts ='])
+            lines.extend('    component-%d' % component
+                         for component in range(components))
+    for component in range(components):
+        lines.extend(['[component-%d]' % component,
+                      'recipe = %s' % factory,
+                      'user = www-data',
+                      'home = /srv/component-%d' % component])
+    return '\n'.join(lines) + '\n'
+
+
+def count(recipe):
+    """Return number of recipes in tree."""
+    return 1 + sum(count(child)
+                   for child in recipe.requirements + recipe.parts)
+
+
+def measure(variant, environments, machines, components):
+    """Build tree and print (nodes, bytes, seconds)."""
+    configuration = generate_configuration(environments, machines, components,
+                                           VARIANTS[variant])
+    reader = ConfigParserReader(StringIO(configuration))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    tree = reader.parse()
+    duration = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.write('%d %d %f\n' % (count(tree), (after - before) * 1024,
+                                     duration))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--environments', type='int', default=10)
+    parser.add_option('--machines', type='int', default=100)
+    parser.add_option('--components', type='int', default=100)
+    parser.add_option('--variant', choices=VARIANTS.keys(), default=None,
+                      help='Run a single variant in this process.')
+    (options, arguments) = parser.parse_args()
+    if options.variant:
+        measure(options.variant, options.environments, options.machines,
+                options.components)
+        return
+    for variant in sorted(VARIANTS):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--variant=%s' % variant,
+             '--environments=%d' % options.environments,
+             '--machines=%d' % options.machines,
+             '--components=%d' % options.components])
+        (nodes, size, duration) = output.split()
+        nodes, size, duration = int(nodes), int(size), float(duration)
+        sys.stdout.write('%-8s %7d recipes %8.1f MB %6.0f bytes/recipe '
+                         '%6.2fs\n' % (variant, nodes, size / 1024. ** 2,
+                                       float(size) / nodes, duration))
+
+
+if __name__ == '__main__':
+    main()
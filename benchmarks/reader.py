@@ -0,0 +1,75 @@
+"""Benchmark configuration readers on a large configuration.
+
+Usage::
+
+    python benchmarks/reader.py [--sections=N] [--references=N] [--repeat=N]
+
+Generates a configuration with N sections (20000 by default), each one being
+referenced by several parents, then compares
+:py:class:`~novapost.cookbot.settings.ConfigParserReader` and
+:py:class:`~novapost.cookbot.settings.FastConfigReader`.
+
+"""
+from cStringIO import StringIO
+from optparse import OptionParser
+import sys
+import time
+
+from novapost.cookbot.settings import ConfigParserReader, FastConfigReader
+
+
+def generate_configuration(sections, references):
+    """Return configuration with ``sections`` leaf sections, grouped under
+    parents. Each leaf is referenced by ``references`` parents."""
+    parents = sections / 100 or 1
+    lines = ['[DEFAULT]', 'root = /srv', '', '[main]', 'parts =']
+    lines.extend('    parent-%d' % parent for parent in range(parents))
+    for parent in range(parents):
+        lines.extend(['', '[parent-%d]' % parent, 'parts ='])
+        for reference in range(references):
+            first = ((parent + reference) % parents) * 100
+            lines.extend('    leaf-%d' % leaf
+                         for leaf in range(first, min(first + 100, sections)))
+    for leaf in range(sections):
+        lines.extend(['', '[leaf-%d]' % leaf,
+                      'recipe = novapost.cookbot.recipes:Recipe',
+                      'home = %%(root)s/leaf-%d' % leaf,
+                      'user = www-data',
+                      '; Comment.',
+                      'packages =',
+                      '    nginx',
+                      '    python'])
+    return '\n'.join(lines) + '\n'
+
+
+def measure(reader_class, configuration, repeat):
+    """Return best duration of parsing configuration, in seconds."""
+    durations = []
+    for iteration in range(repeat):
+        configuration_file = StringIO(configuration)
+        start = time.time()
+        reader_class(configuration_file).parse()
+        durations.append(time.time() - start)
+    return min(durations)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sections', type='int', default=20000)
+    parser.add_option('--references', type='int', default=2)
+    parser.add_option('--repeat', type='int', default=3)
+    (options, arguments) = parser.parse_args()
+    configuration = generate_configuration(options.sections,
+                                           options.references)
+    baseline = None
+    for reader_class in (ConfigParserReader, FastConfigReader):
+        duration = measure(reader_class, configuration, options.repeat)
+        if baseline is None:
+            baseline = duration
+        sys.stdout.write('%-20s %8.3fs  x%.1f\n' % (reader_class.__name__,
+                                                    duration,
+                                                    baseline / duration))
+
+
+if __name__ == '__main__':
+    main()
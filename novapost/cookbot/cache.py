@@ -0,0 +1,260 @@
+"""Memoize results of read-only commands, such as "status".
+
+Recipes mark exposed commands as cacheable, see
+:py:meth:`~novapost.cookbot.recipes.Recipe.expose`. Results are cached under
+a key made of:
+
+* recipe's path, command and arguments;
+
+* recipe's options, as configured (i.e. not interpolated);
+
+* values the command reads: values of context keys declared with
+  ``reads``, and values looked up by options' templates, e.g. the
+  interpolated "host" option of ``context['machine']`` for
+  ``${machine.host}``.
+
+Values are represented by their ``repr()``, except dictionaries, options,
+lists and tuples, whose items are represented recursively. So values should
+have a ``repr()`` which reflects their state.
+
+Results are kept in memory and, optionally, in a directory, so that they
+survive runs. Both are bounded in size: least recently used results are
+evicted first. Results must be picklable.
+
+Results are unpickled, so the directory and its files are only read if they
+are owned by the current user and not writable by anyone else.
+
+"""
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from templates import InterpolationError, Options, resolve
+
+
+#: Default maximum size of cached results, in bytes.
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+
+def is_private(path, stat_result=None):
+    """Return True if path is owned by the current user and not writable by
+    group nor others.
+
+    >>> is_private('/tmp')  # Writable by everyone.
+    False
+
+    """
+    if stat_result is None:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return False
+    return (stat_result.st_uid == os.getuid()
+            and not stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def fingerprint(value):
+    """Return representation of value, for cache keys. Options are
+    interpolated.
+
+    >>> fingerprint({'b': [1, 'x'], 'a': None})
+    "{'a': None, 'b': [1, 'x']}"
+
+    """
+    if isinstance(value, (dict, Options)):
+        items = []
+        for key in sorted(value):
+            try:
+                item = fingerprint(value[key])
+            except InterpolationError:
+                item = 'raw:%r' % value.raw(key)
+            items.append('%r: %s' % (key, item))
+        return '{%s}' % ', '.join(items)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(fingerprint(item) for item in value)
+    return repr(value)
+
+
+class CachePolicy(object):
+    """How results of a command are cached."""
+    __slots__ = ('ttl', 'reads')
+
+    def __init__(self, ttl=None, reads=()):
+        """Constructor.
+
+        ``ttl`` is the lifetime of results, in seconds. None means results do
+        not expire.
+
+        ``reads`` is a list of context keys the command reads.
+
+        """
+        self.ttl = ttl
+        self.reads = frozenset(reads)
+
+
+class ResultCache(object):
+    """Results of commands, in memory and optionally on disk."""
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        """Constructor.
+
+        ``directory`` is where results are stored on disk. If None, results
+        are only kept in memory. The directory is ignored if it is not
+        private, see :py:func:`is_private`.
+
+        ``max_size`` is the maximum size of results, in bytes, in memory and
+        on disk.
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (expires, data) per key, LRU first.
+        self.size = 0  # Size of entries, in bytes.
+        self.lock = threading.Lock()
+
+    def key(self, recipe, cmd, cmd_args, policy):
+        """Return cache key of command."""
+        options = recipe.options
+        lookups = set((name,) for name in policy.reads)
+        raw = []
+        for name in sorted(options):
+            value = options.raw(name)
+            template = options.template(name)
+            if template is not None:
+                lookups.update(template.lookups)
+            raw.append((name, value))
+        context = recipe.context
+        values = []
+        for lookup in sorted(lookups):
+            try:
+                value = fingerprint(resolve(context, lookup))
+            except (KeyError, IndexError, AttributeError,
+                    InterpolationError):
+                value = None  # Missing.
+            values.append(('.'.join(lookup), value))
+        key = repr((recipe.path, cmd, list(cmd_args), raw, values))
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        """Return (found, result) tuple."""
+        now = time.time()
+        with self.lock:
+            try:
+                (expires, data) = self.entries.pop(key)
+            except KeyError:
+                entry = self.read(key)
+            else:
+                entry = (expires, data)
+                self.size -= len(data)
+            if entry is None:
+                return (False, None)
+            (expires, data) = entry
+            if expires is not None and expires <= now:
+                self.remove(key)
+                return (False, None)
+            self.store(key, expires, data)
+        return (True, pickle.loads(data))
+
+    def set(self, key, result, ttl=None):
+        """Cache result for ``ttl`` seconds (forever if None). Unpicklable
+        results are not cached."""
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.remove(key)
+            self.store(key, expires, data)
+            self.write(key, expires, data)
+
+    def store(self, key, expires, data):
+        """Store entry in memory, as most recently used. Evict least recently
+        used entries if needed."""
+        if len(data) > self.max_size:
+            return
+        self.entries[key] = (expires, data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            (_, (_, evicted)) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def remove(self, key):
+        """Remove entry from memory and disk."""
+        try:
+            (_, data) = self.entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.size -= len(data)
+        if self.directory is not None:
+            try:
+                os.unlink(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+    def read(self, key):
+        """Return (expires, data) entry from disk, or None."""
+        if self.directory is None:
+            return None
+        if not is_private(self.directory):
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as entry_file:
+                if not is_private(path, os.fstat(entry_file.fileno())):
+                    return None
+                entry = pickle.load(entry_file)
+            os.utime(path, None)  # Most recently used.
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def write(self, key, expires, data):
+        """Write entry to disk atomically, evict least recently used entries
+        if needed."""
+        if self.directory is None or len(data) > self.max_size:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        if not is_private(self.directory):
+            return
+        (handle, temporary_path) = tempfile.mkstemp(dir=self.directory,
+                                                    prefix='.')
+        try:
+            with os.fdopen(handle, 'wb') as temporary_file:
+                pickle.dump((expires, data), temporary_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary_path, os.path.join(self.directory, key))
+        except Exception:
+            os.unlink(temporary_path)
+            raise
+        self.evict_files()
+
+    def evict_files(self):
+        """Remove least recently used files until directory fits in
+        max_size."""
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        files.sort()
+        for (_, size, name) in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
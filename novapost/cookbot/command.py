@@ -1,56 +1,308 @@
 """Implementation of ``cookbot`` script."""
 from optparse import OptionParser
+import sys
+import time
 
-from settings import ConfigParserReader
+from cache import ResultCache
+from settings import FastConfigReader
 from context import Context
+from dryrun import DryRun, load_durations
+from events import EventLog
+from locks import LockManager
+from metrics import MetricsCollector
+from profiling import Profiler
+from reverse import REVERSE_COMMANDS, ReverseExecutor
+from selection import RecipeIndex
+from transports import SessionPool
+from watch import Watcher
 
 
 class Command(object):
     """Command class."""
     def __init__(self):
         """Constructor."""
-        self.cmd = None  # The command to invoke.
+        self.cmd = None  # The command (or list of commands) to invoke.
         self.cmd_args = []  # List of arguments for the command.
-        self.cfg = None
+        self.cfg = 'etc/cookbot.cfg'  # Path to configuration file.
+        self.reader = None  # Configuration reader.
+        self.recipe = None  # Root recipe.
+        self.selectors = []  # Selectors of recipes to run on.
+        self.index = None  # Index of recipe tree, to evaluate selectors.
+        self.selection = None  # Run only on these recipes, see selection.py.
+        self.watch = False  # Watch configuration and re-run on changes.
         self.environment = None
         self.machine = None
         self.component = None
+        self.timeout = None  # Default timeout of commands, in seconds.
+        self.events = None  # Path of events file, '-' for standard output.
+        self.events_tail = 100  # Number of events kept for error reports.
+        self.metrics = None  # Path of Prometheus metrics file.
+        self.metrics_interval = None  # Seconds between writes of metrics.
+        self.profile = None  # Sections to profile, '*' for all.
+        self.profile_dir = 'cookbot-profile'  # Where to write profiles.
+        self.lazy = False  # Import recipe modules when recipes are used.
+        self.dry_run = False  # Only tell what would run.
+        self.durations = None  # Events file of a previous run, for estimates.
+        self.jobs = 4  # Maximum number of parallel teardowns.
+        self.fail_fast = False  # Stop teardown at first failure.
+        self.lock_dir = None  # Directory of recipe locks. No locks if None.
+        self.cache = True  # Cache results of cacheable commands.
+        self.cache_dir = None  # Where to keep cached results across runs.
+        self.result_cache = None  # Shared by runs, e.g. in watch mode.
 
     def __call__(self):
         """Make it a callable."""
+        context = self.get_context()
+        metrics = context.get('metrics')
+        start = time.time()
+        try:
+            result = self.run(context)
+        except Exception:
+            if metrics is not None:
+                metrics.record_run('failed', time.time() - start)
+            raise
+        else:
+            if metrics is not None:
+                metrics.record_run('succeeded', time.time() - start)
+        finally:
+            self.close_context(context)
+        return result
+
+    def run(self, context):
+        """Execute command on recipe tree."""
+        if self.dry_run:
+            return self.simulate(context)
+        event_log = context.get('event_log')
+        try:
+            if event_log is None:
+                return self.execute(context)
+            with event_log.redirect_output():
+                return event_log.call(None, 'run', self.cmd, self.execute,
+                                      context)
+        except Exception:
+            if event_log is not None:
+                sys.stderr.write('Last events:\n%s' % event_log.format_tail())
+            raise
+
+    def is_reverse(self):
+        """Return True if command is a teardown command, see
+        :py:mod:`~novapost.cookbot.reverse`."""
+        return all(cmd in REVERSE_COMMANDS for cmd in self.cmd)
+
+    def execute(self, context):
+        """Run command on recipe tree, in reverse order for teardown
+        commands."""
+        if self.is_reverse():
+            executor = ReverseExecutor(self.jobs, self.fail_fast)
+            return executor.execute(self.recipe, context, self.cmd,
+                                    self.cmd_args, self.selection)
+        return self.recipe.execute(context, self.cmd, self.cmd_args,
+                                   selection=self.selection)
+
+    def simulate(self, context):
+        """Simulate command on recipe tree, report to standard output. Return
+        :py:class:`~novapost.cookbot.dryrun.DryRun`."""
+        durations = None
+        if self.durations:
+            with open(self.durations) as events:
+                durations = load_durations(events)
+        dry_run = DryRun(durations)
+        executor = ReverseExecutor(jobs=1) if self.is_reverse() else None
+        dry_run.execute(self.recipe, context, self.cmd, self.cmd_args,
+                        self.selection, executor)
+        dry_run.report(sys.stdout, self.recipe)
+        return dry_run
+
+    def get_context(self):
+        """Return initial context of execution."""
         context = Context()
-        return self.recipe.execute(context, self.cmd, self.cmd_args)
+        if self.timeout:
+            context['timeout'] = self.timeout
+        context['session_pool'] = SessionPool()
+        if self.events == '-':
+            context['event_log'] = EventLog(sys.stdout, self.events_tail,
+                                            echo=False)
+        elif self.events:
+            context['event_log'] = EventLog(open(self.events, 'w'),
+                                            self.events_tail)
+        if self.metrics:
+            metrics = MetricsCollector(self.metrics, self.metrics_interval)
+            metrics.load()  # Totals of previous runs.
+            context['metrics'] = metrics
+        if self.cache:
+            if self.result_cache is None:
+                self.result_cache = ResultCache(self.cache_dir)
+            context['cache'] = self.result_cache
+        if self.lock_dir:
+            context['locks'] = LockManager(self.lock_dir)
+        if self.profile:
+            sections = None if self.profile == '*' else self.profile.split(',')
+            context['profiler'] = Profiler(self.profile_dir, sections)
+        return context
+
+    def close_context(self, context):
+        """Release resources of context created with :py:meth:`get_context`.
+        """
+        context['session_pool'].close()
+        event_log = context.get('event_log')
+        if event_log is not None and event_log.stream is not sys.stdout:
+            event_log.stream.close()
+        metrics = context.get('metrics')
+        if metrics is not None:
+            metrics.write()
+        profiler = context.get('profiler')
+        if profiler is not None:
+            profiler.report(sys.stderr)
+
+    def load_configuration(self):
+        """Read configuration file, assign self.reader and self.recipe.
+
+        Also evaluate self.selectors, if any, into self.selection.
+
+        """
+        with open(self.cfg) as configuration_fp:
+            self.reader = FastConfigReader(configuration_fp, lazy=self.lazy)
+            self.recipe = self.reader.parse()
+        self.index = RecipeIndex(self.recipe)
+        if self.selectors:
+            self.selection = self.index.select(self.selectors)
 
     def parse_shell_args(self, *args, **kwargs):
         """Get configuration from :py:meth:`OptionParser.parse_args`."""
         # Defaults.
-        configuration_file = 'etc/cookbot.cfg'
         cmd = None
         cmd_args = []
-        recipe = None
         # Create and configure parser.
-        parser = OptionParser()
-        # Parse input.
-        (options, arguments) = parser.parse_args(*args, **kwargs)
+        parser = OptionParser(usage='%prog [options] [watch] '
+                                    'command[,command...] [arguments]')
+        parser.add_option('-c', '--config', metavar='FILE',
+                          default=self.cfg,
+                          help='Configuration file. Default is %default.')
+        parser.add_option('--timeout', type='float', default=None,
+                          help='Default timeout of commands, in seconds. '
+                               'Recipes override it with "timeout" option.')
+        parser.add_option('--events', metavar='FILE', default=None,
+                          help='Write events to FILE, as JSON lines. Use "-" '
+                               'for standard output.')
+        parser.add_option('--events-tail', metavar='N', type='int',
+                          default=100,
+                          help='Number of last events reported on errors.')
+        parser.add_option('--metrics', metavar='FILE', default=None,
+                          help='Write metrics to FILE, in Prometheus text '
+                               'format.')
+        parser.add_option('--metrics-interval', metavar='SECONDS',
+                          type='float', default=None,
+                          help='Also write metrics every SECONDS during run.')
+        parser.add_option('--profile', metavar='SECTION,...', default=None,
+                          help='Profile commands of recipes in sections. Use '
+                               '"--profile" alone to profile every recipe. '
+                               'Write "--profile=SECTION,..." to give '
+                               'sections.')
+        parser.add_option('--profile-dir', metavar='DIRECTORY',
+                          default=self.profile_dir,
+                          help='Where to write profiles. Default is '
+                               '%default.')
+        parser.add_option('--select', metavar='SELECTOR[,SELECTOR...]',
+                          action='append', default=[],
+                          help='Run only on recipes matching selectors, '
+                               'e.g. "prod/**/nginx", "*/db" or '
+                               '"recipe=module:Class". Can be repeated.')
+        parser.add_option('--jobs', metavar='N', type='int',
+                          default=self.jobs,
+                          help='Maximum number of recipes torn down in '
+                               'parallel, e.g. by "uninstall". Default is '
+                               '%default.')
+        parser.add_option('--fail-fast', action='store_true', default=False,
+                          help='Stop teardown at first failure.')
+        parser.add_option('--lock-dir', metavar='DIRECTORY', default=None,
+                          help='Lock recipes in DIRECTORY during commands, '
+                               'so that concurrent runs sharing DIRECTORY '
+                               'wait for each other on the same recipes.')
+        parser.add_option('--cache-dir', metavar='DIRECTORY', default=None,
+                          help='Keep results of cacheable commands in '
+                               'DIRECTORY, across runs. DIRECTORY must be '
+                               'private to the current user.')
+        parser.add_option('--no-cache', action='store_false', dest='cache',
+                          default=True,
+                          help='Do not use cached results of commands.')
+        parser.add_option('--lazy', action='store_true', default=False,
+                          help='Import recipe modules only when recipes are '
+                               'used.')
+        parser.add_option('--dry-run', action='store_true', default=False,
+                          help='Do not run commands, tell what would run and '
+                               'estimate duration.')
+        parser.add_option('--durations', metavar='FILE', default=None,
+                          help='Events file of a previous run (see '
+                               '--events), used by --dry-run to estimate '
+                               'durations.')
+        # Parse input. "--profile" without value means "every section".
+        arguments = kwargs.pop('args', args[0] if args else None)
+        if arguments is None:
+            arguments = sys.argv[1:]
+        arguments = list(arguments)
+        for index, argument in enumerate(arguments):
+            if argument == '--':
+                break
+            if argument != '--profile':
+                continue
+            following = arguments[index + 1:]
+            if len(following) > 1 and not following[0].startswith('-'):
+                # "--profile www update": sections or command?
+                parser.error('Ambiguous "--profile %s". Use '
+                             '"--profile=SECTION,..." to profile sections.'
+                             % following[0])
+            arguments[index] = '--profile=*'
+        (options, arguments) = parser.parse_args(arguments, *args[1:],
+                                                 **kwargs)
         # Check options and arguments.
-        # Load configuration.
-        with open(configuration_file) as configuration_fp:
-            recipe = ConfigParserReader(configuration_fp).parse()
+        watch = bool(arguments) and arguments[0] == 'watch'
+        if watch:
+            arguments = arguments[1:]
         # Check command.
         if not arguments:
             parser.error('Missing command to run.')
-        cmd = arguments[0]
+        cmd = arguments[0].split(',')
+        reverse = [item in REVERSE_COMMANDS for item in cmd]
+        if any(reverse) and not all(reverse):
+            parser.error('Cannot mix %s with other commands.'
+                         % ', '.join(sorted(REVERSE_COMMANDS)))
+        if options.jobs < 1:
+            parser.error('--jobs must be at least 1.')
         # Command arguments.
         if len(arguments) > 1:
             cmd_args = arguments[1:]
         # Assign local configuration to self.
-        self.recipe = recipe
+        self.cfg = options.config
+        self.watch = watch
         self.cmd = cmd
         self.cmd_args = cmd_args
+        self.timeout = options.timeout
+        self.events = options.events
+        self.events_tail = options.events_tail
+        self.metrics = options.metrics
+        self.metrics_interval = options.metrics_interval
+        self.profile = options.profile
+        self.profile_dir = options.profile_dir
+        self.lazy = options.lazy
+        self.selectors = options.select
+        self.dry_run = options.dry_run
+        self.durations = options.durations
+        self.jobs = options.jobs
+        self.fail_fast = options.fail_fast
+        self.lock_dir = options.lock_dir
+        self.cache = options.cache
+        self.cache_dir = options.cache_dir
+        # Load configuration.
+        self.load_configuration()
+        if self.selectors and not len(self.selection):
+            parser.error('No recipe matches %s.' % ', '.join(self.selectors))
 
 
 def main():
     """Runs command."""
     command = Command()
     command.parse_shell_args()
-    command()
+    if command.watch:
+        Watcher(command).run()
+    else:
+        command()
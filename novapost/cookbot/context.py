@@ -1,6 +1,10 @@
 """Manage context variables as dictionary-like stacks."""
 
 
+#: Marker for keys which have been removed from context, in diffs.
+UNDEFINED = object()
+
+
 class Context(object):
     """Context manager. Handles stacks as a dictionary-like store.
     
@@ -36,10 +40,50 @@ class Context(object):
     >>> len(c)
     1
 
+    Each change increments a version counter, so that derived data can be
+    cached and invalidated cheaply:
+
+    >>> v = c.version('a')
+    >>> c['a'] = 3
+    >>> c.version('a') > v
+    True
+    >>> c.version('unknown')
+    0
+
+    Snapshots and diffs tell which keys changed:
+
+    >>> snapshot = c.snapshot()
+    >>> c.push('b')
+    >>> c['b'] = 'beta'
+    >>> c.diff(snapshot)
+    {'b': 'beta'}
+
+    Watchers are notified of changes:
+
+    >>> def watcher(key, event):
+    ...     print key, event
+    >>> c.watch(watcher, keys=['a'])
+    >>> c['a'] = 4
+    a set
+    >>> c['b'] = 'bravo'
+    >>> c.unwatch(watcher)
+    >>> c['a'] = 5
+
+    Forks are independent copies, e.g. to simulate changes:
+
+    >>> fork = c.fork()
+    >>> fork.pop('b')
+    'bravo'
+    >>> fork.get('b'), c['b']
+    (None, 'bravo')
+
     """
     def __init__(self):
         """Constructor."""
         self.stacks = {}
+        self.clock = 0  # Incremented on every change.
+        self.versions = {}  # Value of clock at last change, per key.
+        self.watchers = []  # List of (callback, keys) tuples.
 
     def __len__(self):
         return len(self.stacks)
@@ -53,13 +97,22 @@ class Context(object):
         except KeyError:
             self.stacks[key] = []
             self.stacks[key].append(value)
+        self.touch(key, 'set')
 
     def __delitem__(self, key):
         del self.stacks[key]
+        self.touch(key, 'del')
 
     def __iter__(self):
         return iter(self.stacks)
 
+    def get(self, key, default=None):
+        """Return value at key if any, else default."""
+        try:
+            return self.stacks[key][0]
+        except (KeyError, IndexError):
+            return default
+
     def push(self, key):
         """Push stack at key."""
         try:
@@ -67,7 +120,77 @@ class Context(object):
         except KeyError:
             self.stacks[key] = []
             self.push(key)
+        else:
+            self.touch(key, 'push')
 
     def pop(self, key):
         """Pop key and return value."""
-        return self.stacks[key].pop(0)
+        value = self.stacks[key].pop(0)
+        self.touch(key, 'pop')
+        return value
+
+    def touch(self, key, event):
+        """Increment version of key and notify watchers.
+
+        ``event`` is one of "set", "del", "push" or "pop".
+
+        """
+        self.clock += 1
+        self.versions[key] = self.clock
+        for (callback, keys) in self.watchers:
+            if keys is None or key in keys:
+                callback(key, event)
+
+    def version(self, key):
+        """Return version of key, i.e. a number which changes whenever the
+        stack at key is changed. Returns 0 for keys never set."""
+        return self.versions.get(key, 0)
+
+    def watch(self, callback, keys=None):
+        """Register ``callback(key, event)`` to be called on changes.
+
+        If ``keys`` is not None, callback is called only for changes of these
+        keys.
+
+        """
+        if keys is not None:
+            keys = frozenset(keys)
+        self.watchers.append((callback, keys))
+
+    def unwatch(self, callback):
+        """Unregister callback."""
+        self.watchers = [(registered, keys)
+                         for (registered, keys) in self.watchers
+                         if registered != callback]
+
+    def fork(self):
+        """Return a copy of context, which can be changed without altering
+        this one. Values are shared, watchers are not copied."""
+        context = self.__class__()
+        context.stacks = dict((key, list(stack))
+                              for key, stack in self.stacks.iteritems())
+        context.clock = self.clock
+        context.versions = dict(self.versions)
+        return context
+
+    def snapshot(self):
+        """Return a marker to be passed to :py:meth:`diff` later."""
+        return self.clock
+
+    def diff(self, snapshot):
+        """Return dictionary of keys changed since snapshot, with their
+        current values.
+
+        Keys which are no longer available have :py:data:`UNDEFINED` value.
+
+        """
+        changes = {}
+        if snapshot == self.clock:
+            return changes
+        for key, version in self.versions.iteritems():
+            if version > snapshot:
+                try:
+                    changes[key] = self.stacks[key][0]
+                except (KeyError, IndexError):
+                    changes[key] = UNDEFINED
+        return changes
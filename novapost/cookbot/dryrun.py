@@ -0,0 +1,170 @@
+"""Simulate execution: tell what would run, estimate how long it would take.
+
+Implementation of ``cookbot --dry-run <command>``. The recipe tree is
+traversed as usual, contexts are entered and exited with the recipes' own
+logic, but against a fork of the context, and commands are recorded instead
+of being called.
+
+Durations are estimated from the events of a previous run (see
+:py:mod:`~novapost.cookbot.events`).
+
+"""
+import json
+
+
+#: Types of context values shown in reports.
+REPORTED_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+def load_durations(stream):
+    """Return dictionary of durations per ``(path, command)``, read from an
+    events stream.
+
+    >>> from cStringIO import StringIO
+    >>> load_durations(StringIO('''
+    ... {"path": "main/www", "phase": "command", "command": "update",
+    ...  "status": "start"}
+    ... {"path": "main/www", "phase": "command", "command": "update",
+    ...  "status": "ok", "duration": 1.5}
+    ... '''.replace('\\n ', ' ')))
+    {(u'main/www', u'update'): 1.5}
+
+    """
+    durations = {}
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        event = json.loads(line)
+        if event.get('phase') == 'command' and 'duration' in event:
+            durations[(event['path'], event['command'])] = event['duration']
+    return durations
+
+
+class Step(object):
+    """Command which would be run (or not) by a dry run."""
+    __slots__ = ('path', 'command', 'status', 'context', 'duration')
+
+    def __init__(self, path, command, status, context, duration=None):
+        """Constructor.
+
+        ``status`` is either "run" or "skipped" (command is not exposed).
+
+        ``context`` is a dictionary of context values seen by the command.
+
+        ``duration`` is the estimated duration, in seconds, or None if
+        unknown.
+
+        """
+        self.path = path
+        self.command = command
+        self.status = status
+        self.context = context
+        self.duration = duration
+
+    def __repr__(self):
+        return '<%s %s %s %s>' % (self.__class__.__name__, self.status,
+                                  self.path, self.command)
+
+
+class DryRun(object):
+    """Record commands instead of running them.
+
+    Recipes record their commands in the "dry_run" value of context, see
+    :py:meth:`~novapost.cookbot.recipes.Recipe.run_command`.
+
+    """
+    def __init__(self, durations=None):
+        """Constructor.
+
+        ``durations`` is a dictionary of durations per ``(path, command)``,
+        see :py:func:`load_durations`.
+
+        """
+        self.durations = durations or {}
+        self.steps = []
+        self.steps_by_path = {}
+
+    def execute(self, recipe, context, cmd, cmd_args=[], selection=None,
+                executor=None):
+        """Simulate ``recipe.execute(context, cmd, cmd_args)`` on a fork of
+        context. Return list of steps.
+
+        If ``executor`` is given, e.g. a
+        :py:class:`~novapost.cookbot.reverse.ReverseExecutor`, simulate
+        ``executor.execute(recipe, context, cmd, cmd_args)`` instead.
+
+        """
+        context = context.fork()
+        context['dry_run'] = self
+        if executor is None:
+            recipe.execute(context, cmd, cmd_args, selection=selection)
+        else:
+            executor.execute(recipe, context, cmd, cmd_args, selection)
+        return self.steps
+
+    def record(self, recipe, cmd):
+        """Record command of recipe. Return :py:class:`Step`."""
+        status = 'run' if recipe.is_exposed(cmd) else 'skipped'
+        context = recipe.context
+        values = dict((key, context.get(key)) for key in context
+                      if key != 'dry_run')
+        duration = None
+        if status == 'run':
+            duration = self.durations.get((recipe.path, cmd))
+        step = Step(recipe.path, cmd, status, values, duration)
+        self.steps.append(step)
+        self.steps_by_path.setdefault(recipe.path, []).append(step)
+        return step
+
+    def own_duration(self, recipe):
+        """Return estimated duration of recipe's own commands."""
+        return sum(step.duration or 0.
+                   for step in self.steps_by_path.get(recipe.path, ()))
+
+    def total(self):
+        """Return estimated duration of the run, commands run one after the
+        other."""
+        return sum(step.duration or 0. for step in self.steps)
+
+    def critical_path(self, recipe):
+        """Return estimated duration of the longest chain of dependent
+        commands in recipe's tree: the run would take that long if
+        independent branches ran in parallel.
+
+        Requirements run before the recipe, parts after it.
+
+        """
+        before = max([self.critical_path(requirement)
+                      for requirement in recipe.requirements] or [0.])
+        after = max([self.critical_path(part) for part in recipe.parts]
+                    or [0.])
+        return before + self.own_duration(recipe) + after
+
+    def report(self, stream, recipe):
+        """Write steps and estimates to stream. ``recipe`` is the root of the
+        simulated tree."""
+        counts = {'run': 0, 'skipped': 0}
+        unknown = 0
+        for step in self.steps:
+            counts[step.status] += 1
+            if step.status == 'run' and step.duration is None:
+                unknown += 1
+            duration = '' if step.duration is None \
+                else '%.2fs' % step.duration
+            line = '%-9s %-40s %-12s %8s' % (step.status, step.path,
+                                             step.command, duration)
+            stream.write(line.rstrip() + '\n')
+            if step.status == 'run':
+                values = ', '.join('%s=%r' % (key, value) for key, value
+                                   in sorted(step.context.items())
+                                   if isinstance(value, REPORTED_TYPES))
+                if values:
+                    stream.write('          context: %s\n' % values)
+        stream.write('%d commands to run, %d skipped.\n'
+                     % (counts['run'], counts['skipped']))
+        stream.write('Estimated duration: %.2fs, critical path: %.2fs'
+                     % (self.total(), self.critical_path(recipe)))
+        if unknown:
+            stream.write(' (%d commands without previous duration)' % unknown)
+        stream.write('.\n')
@@ -0,0 +1,146 @@
+"""Structured log of execution events, streamed as JSON lines.
+
+Each event is a JSON document on its own line, written (and flushed) as soon
+as it happens, so that consumers can follow progress live. Events have the
+following keys:
+
+* ``time``: timestamp.
+
+* ``path``: path of the recipe in tree, e.g. "main/dev/dev-machine".
+
+* ``phase``: "enter", "command", "output" or "exit". The special "run" phase
+  is used by :py:class:`~novapost.cookbot.command.Command` for the whole run.
+
+* ``command``: command name (null for "enter" and "exit" phases).
+
+* ``status``: "start", "ok", "error" or "skipped" (command is not exposed by
+  recipe).
+
+* ``duration``: in seconds, for "ok" and "error" statuses.
+
+* ``error``: error message, for "error" status.
+
+* ``chunk``: output of the command, for "output" phase.
+
+Only the last events are kept in memory (see :py:attr:`EventLog.tail`), so
+memory usage does not depend on the length of the run.
+
+"""
+from collections import deque
+import json
+import sys
+import threading
+import time
+
+
+class EventLog(object):
+    """Write events to a stream, keep the last ones in memory."""
+    def __init__(self, stream=None, tail_size=100, echo=True):
+        """Constructor.
+
+        ``stream`` is a file-like object. If None, events are only kept in
+        memory.
+
+        ``tail_size`` is the number of events kept in memory.
+
+        If ``echo`` is True, output captured with :py:meth:`redirect_output`
+        is also written to the original standard output.
+
+        """
+        self.stream = stream
+        self.tail = deque(maxlen=tail_size)
+        self.echo = echo
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Command producing output, by thread.
+
+    def emit(self, recipe, phase, command=None, status='ok', **fields):
+        """Write event."""
+        fields['time'] = time.time()
+        fields['path'] = getattr(recipe, 'path', None)
+        fields['phase'] = phase
+        fields['command'] = command
+        fields['status'] = status
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.tail.append(line)
+            if self.stream is not None:
+                self.stream.write(line)
+                self.stream.write('\n')
+                self.stream.flush()
+
+    def call(self, recipe, phase, command, func, *args):
+        """Return ``func(*args)``. Emit events when it starts and ends.
+
+        Output of "command" phase is captured, if :py:meth:`redirect_output`
+        is active.
+
+        """
+        self.emit(recipe, phase, command, 'start')
+        start = time.time()
+        if phase == 'command':
+            previous = getattr(self.local, 'target', None)
+            self.local.target = (recipe, command)
+        try:
+            result = func(*args)
+        except BaseException, e:
+            self.emit(recipe, phase, command, 'error',
+                      duration=time.time() - start,
+                      error='%s: %s' % (e.__class__.__name__, e))
+            raise
+        finally:
+            if phase == 'command':
+                self.local.target = previous
+        self.emit(recipe, phase, command, 'ok', duration=time.time() - start)
+        return result
+
+    def redirect_output(self):
+        """Return context manager which captures standard output of commands
+        as "output" events."""
+        return OutputRedirection(self)
+
+    def format_tail(self):
+        """Return last events, as a string."""
+        with self.lock:
+            return ''.join('%s\n' % line for line in self.tail)
+
+
+class OutputRedirection(object):
+    """Replace ``sys.stdout`` with a file-like object which turns writes of
+    commands into events.
+
+    Other attributes, such as ``fileno()``, ``isatty()`` or ``encoding``, are
+    those of the replaced stream. Hence subprocesses given ``sys.stdout``
+    write to the replaced stream directly, without events.
+
+    """
+    def __init__(self, event_log):
+        """Constructor."""
+        self.event_log = event_log
+        self.stdout = None
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        sys.stdout = self.stdout
+
+    def write(self, chunk):
+        target = getattr(self.event_log.local, 'target', None)
+        if target is not None and chunk:
+            (recipe, command) = target
+            self.event_log.emit(recipe, 'output', command, 'ok', chunk=chunk)
+            if not self.event_log.echo:
+                return
+        self.stdout.write(chunk)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
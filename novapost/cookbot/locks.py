@@ -0,0 +1,128 @@
+"""Lock recipes across processes, so that concurrent runs on one host do not
+trample each other.
+
+Each command holds a lock on its recipe's path, and shared locks on the
+paths of the recipe's ancestors. Runs on distinct subtrees proceed
+concurrently. Runs on the same recipe wait for each other, and so do
+commands of a recipe and commands of its descendants.
+
+Locks are :py:func:`fcntl.flock` locks on files in a directory. Runs which
+share the directory share locks, so use one directory per configuration.
+Locks are taken from root to leaf, and only for the duration of a command,
+so concurrent runs do not deadlock.
+
+"""
+import errno
+import fcntl
+import os
+import threading
+import time
+import urllib
+
+
+class RecipeLock(object):
+    """Context manager which locks a recipe path."""
+    def __init__(self, manager, path):
+        """Constructor."""
+        self.manager = manager
+        self.path = path
+        self.files = []
+        self.wait = 0.  # Time spent waiting for the lock, in seconds.
+
+    def acquire(self):
+        """Block until lock is acquired."""
+        (self.files, self.wait) = self.manager.acquire(self.path)
+
+    def release(self):
+        """Release lock."""
+        self.manager.release(self.files)
+        self.files = []
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+
+class LockManager(object):
+    """Acquire locks of recipe paths, record wait times."""
+    def __init__(self, directory):
+        """Constructor. ``directory`` holds lock files."""
+        self.directory = directory
+        self.mutex = threading.Lock()
+        self.acquisitions = 0
+        self.contentions = 0  # Acquisitions which had to wait.
+        self.wait_total = 0.
+        self.wait_max = 0.
+
+    def lock_file(self, path):
+        """Return path of lock file of recipe path.
+
+        >>> LockManager('/var/lock/cookbot').lock_file('main/prod/www')
+        '/var/lock/cookbot/main%2Fprod%2Fwww.lock'
+
+        """
+        return os.path.join(self.directory,
+                            '%s.lock' % urllib.quote(path, safe=''))
+
+    def lock(self, path):
+        """Return :py:class:`RecipeLock` of recipe path."""
+        return RecipeLock(self, path)
+
+    def acquire(self, path):
+        """Lock ancestors of path (shared) and path (exclusive), block until
+        locks are acquired. Return (list of lock files, wait time) tuple."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        segments = path.split('/')
+        files = []
+        wait = 0.
+        try:
+            for index in range(1, len(segments) + 1):
+                if index == len(segments):
+                    mode = fcntl.LOCK_EX
+                else:
+                    mode = fcntl.LOCK_SH
+                lock_file = open(self.lock_file('/'.join(segments[:index])),
+                                 'a')
+                files.append(lock_file)
+                try:
+                    fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    start = time.time()
+                    fcntl.flock(lock_file, mode)
+                    wait += time.time() - start
+        except BaseException:
+            self.release(files)
+            raise
+        with self.mutex:
+            self.acquisitions += 1
+            if wait:
+                self.contentions += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+        return (files, wait)
+
+    def release(self, files):
+        """Release locks acquired with :py:meth:`acquire`."""
+        for lock_file in reversed(files):
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            finally:
+                lock_file.close()
+
+    def stats(self):
+        """Return dictionary of statistics about lock waits."""
+        with self.mutex:
+            return {'acquisitions': self.acquisitions,
+                    'contentions': self.contentions,
+                    'wait_total': self.wait_total,
+                    'wait_max': self.wait_max}
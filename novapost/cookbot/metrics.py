@@ -0,0 +1,315 @@
+"""Collect metrics of runs, export them in Prometheus text format.
+
+Metrics are written to a file, for use with the textfile collector of
+Prometheus' node exporter. Files are replaced atomically, so that the
+collector never reads partial files.
+
+Each run writes its own collector, so counters and histograms of previous
+runs are loaded from the file first (see :py:meth:`MetricsCollector.load`):
+they keep counting across runs. Gauges are about the last run.
+
+Exported metrics:
+
+* ``cookbot_recipe_commands_total``: counter of commands, per section,
+  recipe class, command and status ("executed", "skipped" or "failed").
+
+* ``cookbot_recipe_command_duration_seconds``: histogram of command
+  durations, per section, recipe class and command.
+
+* ``cookbot_runs_total``: counter of runs, per status ("succeeded" or
+  "failed").
+
+* ``cookbot_run_duration_seconds``: histogram of run durations.
+
+* ``cookbot_last_run_timestamp_seconds``, ``cookbot_last_run_duration_seconds``
+  and ``cookbot_last_run_success``: gauges about the last run.
+
+* ``cookbot_lock_wait_seconds``: histogram of time spent waiting for recipe
+  locks, see :py:mod:`~novapost.cookbot.locks`.
+
+* ``cookbot_cache_requests_total``: counter of lookups of cached commands,
+  per result ("hit" or "miss"), see :py:mod:`~novapost.cookbot.cache`.
+
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+#: Default upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
+
+METRICS_HELP = {
+    'cookbot_recipe_commands_total': 'Number of recipe commands.',
+    'cookbot_recipe_command_duration_seconds': 'Duration of recipe commands.',
+    'cookbot_runs_total': 'Number of cookbot runs.',
+    'cookbot_run_duration_seconds': 'Duration of cookbot runs.',
+    'cookbot_last_run_timestamp_seconds': 'End time of last cookbot run.',
+    'cookbot_last_run_duration_seconds': 'Duration of last cookbot run.',
+    'cookbot_last_run_success': 'Whether last cookbot run succeeded.',
+    'cookbot_lock_wait_seconds': 'Time spent waiting for recipe locks.',
+    'cookbot_cache_requests_total': 'Number of lookups of cached commands.',
+}
+
+
+#: Matches a sample line: name, labels (optional) and value.
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+
+#: Matches a label in labels of a sample line.
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class Histogram(object):
+    """Counts of observations in buckets, with sum and count."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        """Constructor."""
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        """Add observation."""
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=()):
+    """Return labels in Prometheus text format.
+
+    >>> format_labels((('section', 'www'), ('command', 'update')))
+    '{section="www",command="update"}'
+    >>> format_labels((), (('le', '+Inf'),))
+    '{le="+Inf"}'
+    >>> format_labels(())
+    ''
+
+    """
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                     .replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def parse_labels(text):
+    """Return labels formatted with :py:func:`format_labels`.
+
+    >>> parse_labels('section="www",command="a\\\\"b"')
+    (('section', 'www'), ('command', 'a"b'))
+    >>> parse_labels(None)
+    ()
+
+    """
+    return tuple((name, re.sub(r'\\(.)', lambda match: {'n': '\n'}.get(
+                     match.group(1), match.group(1)), value))
+                 for (name, value) in LABEL_PATTERN.findall(text or ''))
+
+
+def parse_value(text):
+    """Return number formatted with :py:func:`format_value`."""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def format_value(value):
+    """Return number in Prometheus text format."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsCollector(object):
+    """Aggregate counters, gauges and histograms, write them to a file."""
+    def __init__(self, path=None, flush_interval=None,
+                 buckets=DEFAULT_BUCKETS):
+        """Constructor.
+
+        ``path`` is the file to write metrics to, see :py:meth:`write`.
+
+        If ``flush_interval`` is set, metrics are also written during the
+        run, at most every ``flush_interval`` seconds.
+
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}  # Value per (name, labels).
+        self.gauges = {}  # Value per (name, labels).
+        self.histograms = {}  # Histogram per (name, labels).
+        self.last_flush = time.time()
+
+    def load(self, path=None):
+        """Add counters and histograms of metrics file, e.g. written by a
+        previous run. Histograms with other buckets are ignored, and so are
+        missing files."""
+        path = path or self.path
+        try:
+            with open(path) as metrics_file:
+                lines = metrics_file.read().splitlines()
+        except (IOError, TypeError):
+            return
+        types = {}
+        histograms = {}  # (buckets, sum, count) per (name, labels).
+        with self.lock:
+            for line in lines:
+                if line.startswith('# TYPE '):
+                    (name, metric_type) = line[len('# TYPE '):].split(' ', 1)
+                    types[name] = metric_type
+                    continue
+                match = SAMPLE_PATTERN.match(line)
+                if match is None:
+                    continue
+                (name, labels, value) = match.groups()
+                labels = parse_labels(labels)
+                value = parse_value(value)
+                if types.get(name) == 'counter':
+                    key = (name, labels)
+                    self.counters[key] = self.counters.get(key, 0) + value
+                    continue
+                (name, _, suffix) = name.rpartition('_')
+                if types.get(name) != 'histogram':
+                    continue
+                bound = dict(labels).get('le')
+                labels = tuple(label for label in labels if label[0] != 'le')
+                data = histograms.setdefault((name, labels), ([], [0.], [0]))
+                if suffix == 'bucket':
+                    data[0].append((bound, value))
+                elif suffix == 'sum':
+                    data[1][0] = value
+                elif suffix == 'count':
+                    data[2][0] = value
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            for key, (buckets, total, count) in histograms.items():
+                if [bound for (bound, _) in buckets] != bounds:
+                    continue
+                try:
+                    histogram = self.histograms[key]
+                except KeyError:
+                    histogram = self.histograms[key] = Histogram(self.buckets)
+                previous = 0
+                for index, (_, cumulative) in enumerate(buckets[:-1]):
+                    histogram.counts[index] += cumulative - previous
+                    previous = cumulative
+                histogram.sum += total[0]
+                histogram.count += count[0]
+
+    def increment(self, name, labels=(), value=1):
+        """Increment counter."""
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        """Set gauge."""
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        """Add observation to histogram."""
+        key = (name, labels)
+        with self.lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def record_command(self, recipe, cmd, status, duration=None):
+        """Record command of recipe.
+
+        ``status`` is one of "executed", "skipped" or "failed".
+
+        """
+        recipe_class = recipe.__class__
+        labels = (('section', recipe.name),
+                  ('recipe_class', '%s:%s' % (recipe_class.__module__,
+                                              recipe_class.__name__)),
+                  ('command', cmd))
+        self.increment('cookbot_recipe_commands_total',
+                       labels + (('status', status),))
+        if duration is not None:
+            self.observe('cookbot_recipe_command_duration_seconds', duration,
+                         labels)
+        if self.flush_interval is not None \
+           and time.time() - self.last_flush >= self.flush_interval:
+            self.write()
+
+    def record_run(self, status, duration):
+        """Record run. ``status`` is "succeeded" or "failed"."""
+        self.increment('cookbot_runs_total', (('status', status),))
+        self.observe('cookbot_run_duration_seconds', duration)
+        self.set('cookbot_last_run_timestamp_seconds', time.time())
+        self.set('cookbot_last_run_duration_seconds', duration)
+        self.set('cookbot_last_run_success', int(status == 'succeeded'))
+
+    def render(self):
+        """Return metrics in Prometheus text format."""
+        lines = []
+        with self.lock:
+            metrics = [(name, labels, 'counter', value)
+                       for (name, labels), value in self.counters.items()]
+            metrics.extend((name, labels, 'gauge', value)
+                           for (name, labels), value in self.gauges.items())
+            metrics.extend((name, labels, 'histogram', value)
+                           for (name, labels), value
+                           in self.histograms.items())
+            metrics.sort(key=lambda metric: metric[:2])
+            previous_name = None
+            for (name, labels, metric_type, value) in metrics:
+                if name != previous_name:
+                    lines.append('# HELP %s %s' % (name,
+                                                   METRICS_HELP.get(name, '')))
+                    lines.append('# TYPE %s %s' % (name, metric_type))
+                    previous_name = name
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds, value.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels, (('le', bound),)),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels, (('le', '+Inf'),)),
+                    value.count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              format_value(value.sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                value.count))
+        return ''.join('%s\n' % line for line in lines)
+
+    def write(self, path=None):
+        """Write metrics to file atomically: write a temporary file in the
+        same directory, then rename it."""
+        path = path or self.path
+        self.last_flush = time.time()
+        if path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        (handle, temporary_path) = tempfile.mkstemp(
+            dir=directory, prefix='.%s.' % os.path.basename(path))
+        try:
+            with os.fdopen(handle, 'w') as temporary_file:
+                temporary_file.write(self.render())
+            os.chmod(temporary_path, 0644)
+            os.rename(temporary_path, path)
+        except Exception:
+            os.unlink(temporary_path)
+            raise
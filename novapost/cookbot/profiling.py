@@ -0,0 +1,87 @@
+"""Profile commands of selected recipes, report hotspots of the whole run.
+
+Each profiled command is saved as a ``.pstats`` file, named after recipe's
+path and command. At the end of the run, statistics are merged, so that
+functions which are slow in many recipes (e.g. shared helpers) stand out.
+
+"""
+import cProfile
+import os
+import pstats
+import threading
+
+
+class Profiler(object):
+    """Profile commands of selected recipes."""
+    def __init__(self, directory, sections=None):
+        """Constructor.
+
+        ``directory`` is where ``.pstats`` files are written.
+
+        ``sections`` is a list of section names to profile. If None, every
+        recipe is profiled.
+
+        """
+        self.directory = directory
+        self.sections = None if sections is None else frozenset(sections)
+        self.files = []  # Paths of .pstats files.
+        self.lock = threading.Lock()
+
+    def selects(self, recipe):
+        """Return True if recipe's commands are to be profiled."""
+        return self.sections is None or recipe.name in self.sections
+
+    def call(self, recipe, cmd, func, *args):
+        """Return ``func(*args)``. Profile call and save statistics."""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            name = '%s.%s.pstats' % (recipe.path.replace('/', '.'), cmd)
+            path = os.path.join(self.directory, name)
+            with self.lock:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                profile.dump_stats(path)
+                self.files.append(path)
+
+    def hotspots(self):
+        """Return list of functions, sorted by total internal time.
+
+        Items are tuples ``(function, calls, total time, cumulative time,
+        number of profiled commands which called function)``, where function
+        is a ``(filename, line, name)`` tuple.
+
+        """
+        totals = {}
+        for path in self.files:
+            stats = pstats.Stats(path)
+            for function, (_, calls, total, cumulative, _) \
+                    in stats.stats.items():
+                try:
+                    item = totals[function]
+                except KeyError:
+                    item = totals[function] = [function, 0, 0., 0., 0]
+                item[1] += calls
+                item[2] += total
+                item[3] += cumulative
+                item[4] += 1
+        return sorted((tuple(item) for item in totals.values()),
+                      key=lambda item: item[2], reverse=True)
+
+    def report(self, stream, limit=20):
+        """Write hotspots report to stream, merged statistics to
+        ``merged.pstats`` in directory."""
+        if not self.files:
+            return
+        merged = pstats.Stats(*self.files)
+        merged.dump_stats(os.path.join(self.directory, 'merged.pstats'))
+        stream.write('Profiled %d commands, statistics in %s.\n'
+                     % (len(self.files), self.directory))
+        stream.write('%10s %10s %10s %8s  %s\n'
+                     % ('calls', 'tottime', 'cumtime', 'recipes', 'function'))
+        for (function, calls, total, cumulative, count) \
+                in self.hotspots()[:limit]:
+            stream.write('%10d %10.3f %10.3f %8d  %s\n'
+                         % (calls, total, cumulative, count,
+                            pstats.func_std_string(function)))
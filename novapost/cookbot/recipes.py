@@ -1,4 +1,10 @@
 """Base recipe classes."""
+import time
+
+from cache import CachePolicy
+from templates import FrozenDict, Options
+from timeouts import watchdog
+from transports import LocalTransport, PooledTransport, session_pool
 
 
 class Recipe(object):
@@ -31,17 +37,56 @@ class Recipe(object):
     Recipes can change execution context. See :meth:`enter_context` and
     :meth:`exit_context`.
 
+    Commands can be given a timeout, in seconds, with the "timeout" option.
+    The default is the "timeout" value in context, if any. See
+    :meth:`get_timeout`, :meth:`interrupt` and :meth:`cancel`.
+
+    Read-only commands can be cached, see :meth:`expose`.
+
+    Trees can hold a lot of recipes, so instances are kept small: attributes
+    are declared in ``__slots__`` (subclasses which do not declare
+    ``__slots__`` get a ``__dict__`` as usual), commands exposed by default are
+    shared by all instances until :meth:`expose` is called, and options
+    read from configuration are shared by recipes of the same section until
+    modified.
+
     """
+    __slots__ = ('name', 'path', 'context', 'exposed_commands',
+                 'cache_policies', 'requirements', 'parts', 'context_changes',
+                 'options', 'factory_string')
+
+    #: Commands exposed by default. Shared by instances, hence read-only: use
+    #: :meth:`expose` rather than altering :attr:`exposed_commands` directly.
+    default_exposed_commands = FrozenDict({'install': None,
+                                           'update': None,
+                                           'uninstall': None})
+
+    #: Cache policies of commands, shared by instances like
+    #: :attr:`default_exposed_commands`.
+    default_cache_policies = FrozenDict()
+
     def __init__(self, context, name, options):
         """Constructor."""
         self.name = name
+        self.path = name  # Path in tree. Set by configuration readers.
+        # Factory string from configuration. Set by configuration readers.
+        self.factory_string = None
         self.context = context
-        self.exposed_commands = {}  # Dictionary of exposed commands/callables.
-        self.expose('install')
-        self.expose('update')
-        self.expose('uninstall')
+        cls = self.__class__
+        if not isinstance(cls.default_exposed_commands, FrozenDict):
+            # Plain dictionary of a subclass: freeze it, it is shared.
+            cls.default_exposed_commands = FrozenDict(
+                cls.default_exposed_commands)
+        if not isinstance(cls.default_cache_policies, FrozenDict):
+            cls.default_cache_policies = FrozenDict(
+                cls.default_cache_policies)
+        # Dictionary of exposed commands/callables. Copied on write.
+        self.exposed_commands = cls.default_exposed_commands
+        # Dictionary of cache policies per command. Copied on write.
+        self.cache_policies = cls.default_cache_policies
         self.requirements = []  # List of required recipes.
         self.parts = []  # List of child recipes.
+        self.context_changes = None  # Context changes made by enter_context().
         self.parse_options(options)
 
     def get_default_options(self):
@@ -54,50 +99,255 @@ class Recipe(object):
         return {}
 
     def parse_options(self, options):
-        """Parse options, validate them and populate self.options."""
-        self.options = self.get_default_options()
-        for key, value in options.items():
-            self.options[key] = value
+        """Parse options, validate them and populate self.options.
 
-    def execute(self, context, cmd, cmd_args=[], enter=True, exit=True):
-        """Apply function to recipe's tree in order: requirements, self and
+        Options may contain placeholders, such as ``${user}`` or
+        ``${machine.ip}``, which are interpolated with the recipe's context
+        when the option is read. See
+        :py:class:`~novapost.cookbot.templates.Options`.
+
+        """
+        values = self.get_default_options()
+        if values:
+            values = dict(values)
+            values.update(options)
+        else:
+            values = options  # Shared if frozen, copied otherwise.
+        self.options = Options(self, values)
+
+    def execute(self, context, cmd, cmd_args=[], enter=True, exit=True,
+                selection=None):
+        """Apply command to recipe's tree in order: requirements, self and
         parts.
 
+        ``cmd`` is either a command name or a list of command names. Several
+        commands are run in order at each recipe, so that the tree is
+        traversed (and contexts are entered and exited) only once.
+
         If enter is True, then enter() method is called when a recipe is
         traversed.
 
         If exit is True, then exit() method is called at the end of the
         traversal.
 
+        If context has an "event_log" (see
+        :py:class:`~novapost.cookbot.events.EventLog`), traversal and
+        commands are reported to it.
+
+        If ``selection`` is given (see
+        :py:class:`~novapost.cookbot.selection.Selection`), commands only run
+        on selected recipes and their descendants. Other recipes are only
+        traversed if their context is required.
+
         """
+        if isinstance(cmd, basestring):
+            commands = [cmd]
+        else:
+            commands = cmd
         self.context = context
+        events = context.get('event_log')
+        own_commands = commands
+        if selection is not None:
+            if selection.is_selected(self.path):
+                selection = None
+            else:
+                own_commands = []
+                if not selection.leads_to(self.path):
+                    # Requirement of an ancestor of selected recipes: only
+                    # its context is needed.
+                    commands = []
+                    selection = None
         # Traverse requirements. Keep them open. We will exit them at the end.
         for requirement in self.requirements:
-            requirement.execute(context, cmd, cmd_args, enter, False)
-        # Enter self's context if not special 'install' command.
-        if enter and cmd != 'install':
-            self.enter()
-        # Self execute command.
-        if self.is_exposed(cmd):
-            func = self.get_callable(cmd)
-            if cmd_args:
-                func(cmd_args)
-            else:
-                func()
-        # If command was 'install', enter self's context after execution.
-        if enter and cmd == 'install':
-            self.enter()
+            requirement.execute(context, commands, cmd_args, enter, False,
+                                selection)
+        # Self execute commands. Enter self's context before the first command,
+        # unless it is the special 'install' command: then enter self's context
+        # after its execution.
+        entered = not enter
+        for command in own_commands:
+            if not entered and command != 'install':
+                self.trace('enter', events)
+                entered = True
+            self.run_command(command, cmd_args)
+            if not entered:
+                self.trace('enter', events)
+                entered = True
+        if not entered:
+            self.trace('enter', events)
         # Traverse parts. Exit them as soon as possible.
         for part in self.parts:
-            part.execute(context, cmd, cmd_args, enter, exit)
+            if selection is None or selection.is_selected(part.path) \
+               or selection.leads_to(part.path):
+                part.execute(context, commands, cmd_args, enter, exit,
+                             selection)
+            elif not exit:
+                # Parts will be exited by moonwalk: enter them anyway.
+                part.execute(context, [], cmd_args, enter, exit)
         # Exit, moonwalking.
         if exit:
             # Parts already exited.
             # Exit self's context.
-            self.exit()
+            self.trace('exit', events)
             # Exit requirements recursively.
             for requirement in reversed(self.requirements):
-                requirement.moonwalk('exit')
+                requirement.moonwalk('trace', 'exit', events)
+
+    def trace(self, phase, events=None):
+        """Call :py:meth:`enter` or :py:meth:`exit`, depending on ``phase``,
+        and report it to event log, if any."""
+        func = getattr(self, phase)
+        if events is None:
+            return func()
+        return events.call(self, phase, None, func)
+
+    def run_command(self, cmd, cmd_args=[]):
+        """Run command on self, if exposed. Return command's result.
+
+        Command is reported to context's "event_log" and "metrics", if any.
+
+        If context has a "dry_run" (see
+        :py:class:`~novapost.cookbot.dryrun.DryRun`), command is recorded
+        there instead of being run.
+
+        """
+        dry_run = self.context.get('dry_run')
+        if dry_run is not None:
+            dry_run.record(self, cmd)
+            return None
+        events = self.context.get('event_log')
+        metrics = self.context.get('metrics')
+        if not self.is_exposed(cmd):
+            if events is not None:
+                events.emit(self, 'command', cmd, 'skipped')
+            if metrics is not None:
+                metrics.record_command(self, cmd, 'skipped')
+            return None
+        if metrics is None:
+            if events is None:
+                return self.invoke(cmd, cmd_args)
+            return events.call(self, 'command', cmd, self.invoke, cmd,
+                               cmd_args)
+        start = time.time()
+        try:
+            if events is None:
+                result = self.invoke(cmd, cmd_args)
+            else:
+                result = events.call(self, 'command', cmd, self.invoke, cmd,
+                                     cmd_args)
+        except BaseException:
+            metrics.record_command(self, cmd, 'failed', time.time() - start)
+            raise
+        metrics.record_command(self, cmd, 'executed', time.time() - start)
+        return result
+
+    def invoke(self, cmd, cmd_args=[]):
+        """Call exposed command. Return command's result.
+
+        If :py:meth:`get_timeout` returns a value, the command is interrupted
+        with :py:class:`~novapost.cookbot.timeouts.RecipeTimeout` when it
+        exceeds the timeout.
+
+        If context has a "profiler" (see
+        :py:class:`~novapost.cookbot.profiling.Profiler`) which selects the
+        recipe, the command is profiled.
+
+        If context has "locks" (see
+        :py:class:`~novapost.cookbot.locks.LockManager`), the recipe's path is
+        locked during the command. Waiting for the lock does not count in the
+        timeout.
+
+        If command is cacheable (see :py:meth:`expose`) and context has a
+        "cache" (see :py:class:`~novapost.cookbot.cache.ResultCache`), cached
+        results are returned without calling the command.
+
+        """
+        cache = self.context.get('cache')
+        policy = None
+        if cache is not None:
+            policy = self.cache_policies.get(cmd)
+        metrics = self.context.get('metrics')
+        if policy is not None:
+            key = cache.key(self, cmd, cmd_args, policy)
+            (found, result) = cache.get(key)
+            if metrics is not None:
+                metrics.increment('cookbot_cache_requests_total',
+                                  (('result', 'hit' if found else 'miss'),))
+            if found:
+                return result
+        call = self.call
+        args = (self.get_callable(cmd), cmd_args)
+        profiler = self.context.get('profiler')
+        if profiler is not None and profiler.selects(self):
+            args = (self, cmd, call) + args
+            call = profiler.call
+        timeout = self.get_timeout()
+        lock = None
+        locks = self.context.get('locks')
+        if locks is not None:
+            lock = locks.lock(self.path)
+            lock.acquire()
+            if metrics is not None:
+                metrics.observe('cookbot_lock_wait_seconds', lock.wait)
+        try:
+            if timeout:
+                with watchdog.guard(self, cmd, timeout):
+                    result = call(*args)
+            else:
+                result = call(*args)
+        finally:
+            if lock is not None:
+                lock.release()
+        if policy is not None:
+            cache.set(key, result, policy.ttl)
+        return result
+
+    def call(self, func, cmd_args=[]):
+        """Call command callable with arguments."""
+        if cmd_args:
+            return func(cmd_args)
+        else:
+            return func()
+
+    def get_timeout(self):
+        """Return timeout of commands, in seconds, or None.
+
+        Uses "timeout" option, or "timeout" value in context. Empty or zero
+        values mean no timeout.
+
+        """
+        try:
+            timeout = self.options['timeout']
+        except KeyError:
+            timeout = self.context.get('timeout')
+        if not timeout:
+            return None
+        return float(timeout)
+
+    def interrupt(self, cmd, thread_id):
+        """Called by the watchdog when command ``cmd``, run by thread
+        ``thread_id``, exceeds its timeout.
+
+        Cancels commands the thread runs through "transport" of context, see
+        :py:meth:`~novapost.cookbot.transports.Transport.cancel`, then calls
+        :py:meth:`cancel`. Returns True if a transport command was cancelled.
+
+        """
+        transport = self.context.get('transport')
+        try:
+            return transport is not None and transport.cancel(thread_id)
+        finally:
+            self.cancel(cmd)
+
+    def cancel(self, cmd):
+        """Called by the watchdog when command ``cmd`` exceeds its timeout.
+
+        This method is called from the watchdog's thread, right before the
+        command is interrupted. Override it to cancel the command cleanly, as
+        an example to kill subprocesses not run through the context's
+        transport.
+
+        """
 
     def moonwalk(self, func_name, *args, **kwargs):
         """Apply function to recipe's tree in reverse order: parts, self and
@@ -123,8 +373,14 @@ class Recipe(object):
         * else we suppose that the recipe has already been installed, so we
           can apply the recipe's context before the command call.
 
+        Changes made to the context are recorded in
+        :py:attr:`context_changes`, for debugging and tracing. See
+        :py:meth:`~novapost.cookbot.context.Context.diff`.
+
         """
+        snapshot = self.context.snapshot()
         self.enter_context()
+        self.context_changes = self.context.diff(snapshot)
 
     def exit(self):
         """Called when the recipe is traversed backward.
@@ -141,10 +397,29 @@ class Recipe(object):
         """
         self.exit_context()
 
-    def expose(self, command_id, command_callable=None):
+    def expose(self, command_id, command_callable=None, cacheable=False,
+               ttl=None, reads=()):
         """Register a command to expose: it will be available from the command
-        line."""
+        line.
+
+        If ``cacheable`` is True, results of the command are cached for
+        ``ttl`` seconds (forever if None), see
+        :py:mod:`~novapost.cookbot.cache`. Only use it for read-only commands,
+        which return the same result for the same options and context.
+        ``reads`` is the list of context keys the command reads, in addition
+        to the ones referenced by options.
+
+        """
+        if isinstance(self.exposed_commands, FrozenDict):
+            self.exposed_commands = dict(self.exposed_commands)
         self.exposed_commands[command_id] = command_callable
+        if cacheable or command_id in self.cache_policies:
+            if isinstance(self.cache_policies, FrozenDict):
+                self.cache_policies = dict(self.cache_policies)
+            if cacheable:
+                self.cache_policies[command_id] = CachePolicy(ttl, reads)
+            else:
+                del self.cache_policies[command_id]
 
     def is_exposed(self, command_id, recursive=False):
         """Return True if recipe exposes the given command.
@@ -153,7 +428,7 @@ class Recipe(object):
         True if at least one requirement or part exposes the command.
 
         """
-        is_exposed = command_id in self.exposed_commands.keys()
+        is_exposed = command_id in self.exposed_commands
         if is_exposed:
             return True
         elif recursive:
@@ -225,3 +500,49 @@ class Recipe(object):
 
     def uninstall(self):
         """Uninstall recipe."""
+
+
+class MachineRecipe(Recipe):
+    """Recipe which represents a machine, i.e. where parts run commands.
+
+    Pushes a :py:class:`~novapost.cookbot.transports.Transport` in context, as
+    "transport", and machine's options, as "machine" (so that parts can use
+    ``${machine.host}`` in their options).
+
+    Options:
+
+    * ``host``: host to connect to. If empty, commands run locally.
+
+    * ``port``: port to connect to, required if ``host`` is set.
+
+    * ``max_sessions``: maximum number of sessions open on host.
+
+    Sessions are taken from the pool in context ("session_pool"), or from
+    :py:data:`~novapost.cookbot.transports.session_pool`. So every recipe
+    under the machine reuses the same sessions.
+
+    """
+    __slots__ = ()
+
+    def get_transport(self):
+        """Return transport to machine."""
+        host = self.options.get('host')
+        if not host:
+            return LocalTransport()
+        pool = self.context.get('session_pool') or session_pool
+        max_sessions = self.options.get('max_sessions')
+        if max_sessions:
+            pool.set_limit(host, int(max_sessions))
+        return PooledTransport(pool, host, int(self.options['port']))
+
+    def enter_context(self):
+        """Push "transport" and "machine" in context."""
+        self.context.push('transport')
+        self.context['transport'] = self.get_transport()
+        self.context.push('machine')
+        self.context['machine'] = self.options
+
+    def exit_context(self):
+        """Restore "transport" and "machine" in context."""
+        self.context.pop('machine')
+        self.context.pop('transport').close()
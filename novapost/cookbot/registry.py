@@ -0,0 +1,206 @@
+"""Resolve recipe factories once, import recipe modules lazily.
+
+Factories are referenced by strings in configuration:
+
+* ``module:attribute``, e.g. ``novapost.cookbot.recipes:Recipe``;
+
+* names, which are either registered with :py:meth:`FactoryRegistry.register`
+  or declared as entry points of the "novapost.cookbot.recipes" group by
+  installed distributions. As an example, in ``setup.py``:
+
+  .. code-block:: python
+
+     entry_points={
+         'novapost.cookbot.recipes': [
+             'nginx = mycompany.recipes.nginx:NginxRecipe',
+         ],
+     }
+
+  Then ``recipe = nginx`` is enough in configuration.
+
+"""
+import threading
+
+
+#: Entry point group of recipe factories.
+ENTRY_POINT_GROUP = 'novapost.cookbot.recipes'
+
+
+class FactoryRegistry(object):
+    """Resolve factory strings to factories, once per string."""
+    def __init__(self, entry_point_group=ENTRY_POINT_GROUP):
+        """Constructor."""
+        self.entry_point_group = entry_point_group
+        self.factories = {}  # Resolved factories, per factory string.
+        self.entry_points = None  # Entry points per name, loaded on demand.
+        self.lock = threading.RLock()
+
+    def register(self, name, factory):
+        """Register factory under name."""
+        with self.lock:
+            self.factories[name] = factory
+
+    def resolve(self, factory_string):
+        """Return factory for factory string. Import its module if needed."""
+        try:
+            return self.factories[factory_string]
+        except KeyError:
+            pass
+        with self.lock:
+            try:
+                return self.factories[factory_string]
+            except KeyError:
+                factory = self.load(factory_string)
+                self.factories[factory_string] = factory
+                return factory
+
+    def forget(self, module_name):
+        """Forget factories of module, e.g. after the module was reloaded."""
+        with self.lock:
+            for key, factory in self.factories.items():
+                if getattr(factory, '__module__', None) == module_name:
+                    del self.factories[key]
+
+    def load(self, factory_string):
+        """Import and return factory."""
+        if ':' in factory_string:
+            (path, factory_name) = factory_string.split(':')
+            module = __import__(path, globals(), locals(), [factory_name], -1)
+            return getattr(module, factory_name)
+        try:
+            entry_point = self.get_entry_points()[factory_string]
+        except KeyError:
+            raise ImportError('No recipe factory named %r.' % factory_string)
+        return entry_point.load()
+
+    def qualified_name(self, factory_string):
+        """Return factory string as "module:attribute", without importing
+        the module.
+
+        >>> registry = FactoryRegistry()
+        >>> registry.register('mapping', dict)
+        >>> registry.qualified_name('mapping')
+        '__builtin__:dict'
+        >>> registry.qualified_name('novapost.cookbot.recipes:Recipe')
+        'novapost.cookbot.recipes:Recipe'
+
+        """
+        if ':' in factory_string:
+            return factory_string
+        try:
+            factory = self.factories[factory_string]
+        except KeyError:
+            pass
+        else:
+            return '%s:%s' % (factory.__module__, factory.__name__)
+        try:
+            entry_point = self.get_entry_points()[factory_string]
+        except KeyError:
+            return factory_string
+        return '%s:%s' % (entry_point.module_name, '.'.join(entry_point.attrs))
+
+    def get_entry_points(self):
+        """Return dictionary of entry points of recipe factories."""
+        if self.entry_points is None:
+            import pkg_resources
+            self.entry_points = dict(
+                (entry_point.name, entry_point) for entry_point
+                in pkg_resources.iter_entry_points(self.entry_point_group))
+        return self.entry_points
+
+    def warm_up(self, factory_strings=(), entry_points=True):
+        """Resolve factories in advance, e.g. in a daemon or worker process.
+
+        Resolves ``factory_strings`` and, if ``entry_points`` is True, every
+        entry point.
+
+        """
+        for factory_string in factory_strings:
+            self.resolve(factory_string)
+        if entry_points:
+            for name in self.get_entry_points():
+                self.resolve(name)
+
+
+class LazyRecipe(object):
+    """Proxy of a recipe, which defers import of recipe's module until the
+    recipe is used.
+
+    Tree attributes (name, path, requirements and parts), context and options
+    are available without importing the module. Any other attribute creates
+    the recipe. Once the recipe is created, attributes are read from and
+    written to the recipe.
+
+    .. note::
+
+       Proxies are not instances of recipe classes. Use :py:meth:`materialize`
+       to get the actual recipe.
+
+    """
+    __slots__ = ('registry', 'factory_string', 'recipe', '_context',
+                 '_options', 'name', 'path', 'requirements', 'parts')
+
+    #: Attributes of the proxy itself.
+    proxy_attributes = ('registry', 'factory_string', 'recipe')
+
+    #: Attributes shared by proxy and recipe.
+    tree_attributes = ('name', 'path', 'requirements', 'parts')
+
+    def __init__(self, registry, factory_string, context, name, options):
+        """Constructor."""
+        object.__setattr__(self, 'recipe', None)
+        self.registry = registry
+        self.factory_string = factory_string
+        self.context = context
+        self.options = options
+        self.name = name
+        self.path = name
+        self.requirements = []
+        self.parts = []
+
+    def materialize(self):
+        """Create (once) and return recipe."""
+        recipe = self.recipe
+        if recipe is None:
+            factory = self.registry.resolve(self.factory_string)
+            recipe = factory(self._context, self.name, self._options)
+            for attribute in self.tree_attributes:
+                setattr(recipe, attribute, getattr(self, attribute))
+            recipe.factory_string = self.factory_string
+            object.__setattr__(self, 'recipe', recipe)
+        return recipe
+
+    @property
+    def context(self):
+        if self.recipe is None:
+            return self._context
+        return self.recipe.context
+
+    @property
+    def options(self):
+        if self.recipe is None:
+            return self._options
+        return self.recipe.options
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        if name in self.proxy_attributes:
+            object.__setattr__(self, name, value)
+            return
+        if name in self.tree_attributes:
+            object.__setattr__(self, name, value)
+        elif self.recipe is None and name in ('context', 'options'):
+            object.__setattr__(self, '_%s' % name, value)
+            return
+        if self.recipe is not None or name not in self.tree_attributes:
+            setattr(self.materialize(), name, value)
+
+    def __repr__(self):
+        return '<%s %r of %s>' % (self.__class__.__name__, self.path,
+                                  self.factory_string)
+
+
+#: Registry used by configuration readers.
+registry = FactoryRegistry()
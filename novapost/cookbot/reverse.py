@@ -0,0 +1,202 @@
+"""Run teardown commands, such as "uninstall", in reverse order.
+
+Forward commands run on requirements, then on recipe, then on parts. Reverse
+commands run in the order of
+:py:meth:`~novapost.cookbot.recipes.Recipe.moonwalk`: parts first, then
+recipe, then requirements. Contexts are entered as for forward commands: a
+part's teardown runs in the context of its ancestors and their requirements,
+parts of requirements included.
+
+Parts of a recipe are independent from each other, so their teardowns run in
+parallel threads, each one with a fork of the context.
+
+Requirements with the same section name, required by recipes of the same
+scope (i.e. below the same parent, through requirements), are considered the
+same resource. Such a shared requirement is torn down once, after every
+recipe which requires it. It is kept if one of these recipes is not torn down,
+e.g. because it is not selected.
+
+"""
+import threading
+
+
+#: Commands run by :py:class:`ReverseExecutor`.
+REVERSE_COMMANDS = frozenset(['uninstall'])
+
+
+class TeardownError(Exception):
+    """Raised when commands failed during teardown."""
+    def __init__(self, errors):
+        """Constructor. ``errors`` is a list of (path, exception) tuples."""
+        super(TeardownError, self).__init__(
+            '%d failure(s) during teardown: %s' % (
+                len(errors), '; '.join('%s: %s' % (path, error)
+                                       for (path, error) in errors)))
+        self.errors = errors
+
+
+class ReverseExecutor(object):
+    """Run commands on recipe tree in reverse order, parts in parallel."""
+    def __init__(self, jobs=4, fail_fast=False):
+        """Constructor.
+
+        ``jobs`` is the maximum number of recipes torn down at the same time.
+        When no slot is free, parts are torn down in the current thread.
+
+        If ``fail_fast`` is True, no command is started after a failure.
+
+        """
+        self.jobs = jobs
+        self.fail_fast = fail_fast
+        self.slots = threading.Semaphore(max(jobs - 1, 0))
+        self.lock = threading.Lock()
+        self.pending = {}  # Number of dependents, per shared requirement.
+        self.errors = []  # (path, exception) tuples.
+
+    def execute(self, recipe, context, cmd, cmd_args=[], selection=None):
+        """Run command(s) on recipe tree, in reverse order.
+
+        Arguments are those of
+        :py:meth:`~novapost.cookbot.recipes.Recipe.execute`.
+
+        Raise :py:class:`TeardownError` if some commands failed.
+
+        """
+        if isinstance(cmd, basestring):
+            cmd = [cmd]
+        self.pending = {}
+        self.errors = []
+        self.plan(recipe, '')
+        self.enter(recipe, context)
+        self.run(recipe, context, '', cmd, cmd_args, selection)
+        if self.errors:
+            raise TeardownError(self.errors)
+
+    def plan(self, recipe, scope, count=True):
+        """Count dependents of shared requirements in the whole tree, selected
+        or not.
+
+        Every copy of a shared requirement may be the one torn down, so parts
+        of every copy are planned, in the copy's own scope. Requirements of
+        the shared requirement are counted once, i.e. only if ``count`` is
+        True and for the first copy.
+
+        """
+        for requirement in recipe.requirements:
+            key = (scope, requirement.name)
+            first = key not in self.pending
+            if count:
+                if first:
+                    self.pending[key] = 0
+                self.pending[key] += 1
+            self.plan(requirement, scope, count and first)
+        for part in recipe.parts:
+            self.plan(part, recipe.path)
+
+    def select(self, recipe, selection):
+        """Return (run own commands, selection for descendants) tuple."""
+        if selection is None:
+            return (True, None)
+        if selection.is_selected(recipe.path):
+            return (True, None)
+        return (False, selection)
+
+    def select_parts(self, recipe, selection):
+        """Return parts of recipe to traverse, in teardown order."""
+        return [part for part in reversed(recipe.parts)
+                if selection is None or selection.is_selected(part.path)
+                or selection.leads_to(part.path)]
+
+    def enter(self, recipe, context):
+        """Enter contexts of recipe's requirements, as
+        :py:meth:`~novapost.cookbot.recipes.Recipe.execute` does, then
+        recipe's context."""
+        for requirement in recipe.requirements:
+            requirement.execute(context, [], enter=True, exit=False)
+        recipe.context = context
+        recipe.trace('enter', context.get('event_log'))
+
+    def leave(self, requirement):
+        """Exit contexts of requirement entered by :py:meth:`enter`, without
+        running commands."""
+        requirement.moonwalk('trace', 'exit',
+                             requirement.context.get('event_log'))
+
+    def stopped(self):
+        """Return True if no more commands should start."""
+        return self.fail_fast and bool(self.errors)
+
+    def run(self, recipe, context, scope, commands, cmd_args, selection):
+        """Tear down recipe, whose context has been entered: parts, recipe,
+        then requirements. Exit contexts. Return True on success."""
+        (own, selection) = self.select(recipe, selection)
+        success = self.run_parts(recipe, context, commands, cmd_args,
+                                 selection)
+        success = success and not self.stopped()
+        if own and success:
+            try:
+                for command in commands:
+                    recipe.run_command(command, cmd_args)
+            except Exception, e:
+                self.fail(recipe, e)
+                success = False
+        recipe.trace('exit', context.get('event_log'))
+        for requirement in reversed(recipe.requirements):
+            if own and success and self.release((scope, requirement.name)):
+                # Parts are entered again, one by one, by their teardown.
+                for part in reversed(requirement.parts):
+                    self.leave(part)
+                success = self.run(requirement, context, scope, commands,
+                                   cmd_args, None)
+            else:
+                self.leave(requirement)
+        return success
+
+    def run_parts(self, recipe, context, commands, cmd_args, selection):
+        """Tear down parts, in parallel if slots are free. Return True if
+        every part succeeded."""
+        threads = []
+        results = []
+        for part in self.select_parts(recipe, selection):
+            if self.stopped():
+                results.append(False)
+                break
+            args = (part, context.fork(), recipe.path, commands, cmd_args,
+                    selection, results)
+            if self.slots.acquire(False):
+                thread = threading.Thread(target=self.run_part, args=args)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            else:
+                self.run_part(*args, release_slot=False)
+        for thread in threads:
+            thread.join()
+        return all(results)
+
+    def run_part(self, part, context, scope, commands, cmd_args, selection,
+                 results, release_slot=True):
+        """Enter part's context and tear it down. Append result to
+        ``results``."""
+        try:
+            self.enter(part, context)
+            success = self.run(part, context, scope, commands, cmd_args,
+                               selection)
+        except Exception, e:
+            self.fail(part, e)
+            success = False
+        results.append(success)
+        if release_slot:
+            self.slots.release()
+
+    def release(self, key):
+        """Decrement number of dependents of shared requirement. Return True
+        if the requirement is to be torn down now."""
+        with self.lock:
+            self.pending[key] -= 1
+            return self.pending[key] == 0
+
+    def fail(self, recipe, error):
+        """Record failure."""
+        with self.lock:
+            self.errors.append((recipe.path, error))
@@ -0,0 +1,195 @@
+"""Select subtrees of recipes for targeted execution.
+
+Selectors tell which recipes to select:
+
+* path patterns, relative to the root recipe, e.g. ``prod/**/nginx``. ``*``
+  matches any part of a path segment, ``**`` matches any number of segments;
+
+* ``key=value`` attributes, where value is a pattern. ``recipe`` is the
+  recipe factory, either as configured, e.g. ``recipe=machine``, or as
+  "module:name", e.g. ``recipe=novapost.cookbot.recipes:Recipe``. ``name``
+  is the section name, other keys are options.
+
+"""
+from fnmatch import fnmatchcase
+import re
+
+from registry import LazyRecipe
+from templates import Options
+
+
+def walk(recipe):
+    """Iterate over recipe and its descendants, i.e. requirements and parts,
+    recursively."""
+    stack = [recipe]
+    while stack:
+        recipe = stack.pop()
+        yield recipe
+        stack.extend(reversed(recipe.parts))
+        stack.extend(reversed(recipe.requirements))
+
+
+class Selection(object):
+    """Set of selected recipe paths.
+
+    When given to :py:meth:`~novapost.cookbot.recipes.Recipe.execute`, commands
+    run only on selected recipes and their descendants. Ancestors of selected
+    recipes, and their requirements, are traversed so that their context is
+    entered, but their commands are not run. Other branches are skipped.
+
+    >>> selection = Selection(['main/prod/www', 'main/dev'])
+    >>> selection.is_selected('main/dev')
+    True
+    >>> selection.leads_to('main'), selection.leads_to('main/prod')
+    (True, True)
+    >>> selection.leads_to('main/prod/www'), selection.leads_to('main/staging')
+    (False, False)
+    >>> selection.covers('main/dev/db'), selection.covers('main/prod')
+    (True, False)
+
+    """
+    def __init__(self, paths):
+        """Constructor."""
+        self.paths = frozenset(paths)
+        ancestors = set()
+        for path in self.paths:
+            parts = path.split('/')
+            for index in range(1, len(parts)):
+                ancestors.add('/'.join(parts[:index]))
+        self.ancestors = frozenset(ancestors)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def is_selected(self, path):
+        """Return True if path is selected."""
+        return path in self.paths
+
+    def covers(self, path):
+        """Return True if path or one of its ancestors is selected."""
+        while path:
+            if path in self.paths:
+                return True
+            path = path.rpartition('/')[0]
+        return False
+
+    def leads_to(self, path):
+        """Return True if path is an ancestor of a selected path."""
+        return path in self.ancestors
+
+
+def compile_path_pattern(pattern):
+    """Return regular expression matching paths (followed by "/") which
+    match pattern.
+
+    >>> regex = compile_path_pattern('prod/**/nginx')
+    >>> bool(regex.match('prod/nginx/')), bool(regex.match('prod/a/b/nginx/'))
+    (True, True)
+    >>> bool(compile_path_pattern('*/db').match('staging/staging-db/db/'))
+    False
+    >>> bool(compile_path_pattern('prod-*').match('prod-www/'))
+    True
+
+    """
+    regex = []
+    for segment in pattern.strip('/').split('/'):
+        if segment == '**':
+            regex.append('(?:[^/]+/)*')
+        elif segment:
+            regex.append(''.join('[^/]*' if char == '*'
+                                 else '[^/]' if char == '?'
+                                 else re.escape(char) for char in segment))
+            regex.append('/')
+    regex.append(r'\Z')
+    return re.compile(''.join(regex))
+
+
+def factory_strings(recipe):
+    """Return recipe factory of recipe, as configured (e.g. a registered name)
+    and as "module:name".
+
+    Both forms are available whether recipe is lazy or not, so that ``recipe``
+    selectors give the same results with and without ``--lazy``.
+
+    """
+    configured = getattr(recipe, 'factory_string', None)
+    if isinstance(recipe, LazyRecipe) and recipe.recipe is None:
+        # Do not import recipe's module.
+        qualified = recipe.registry.qualified_name(configured)
+    else:
+        if isinstance(recipe, LazyRecipe):
+            recipe = recipe.recipe
+        recipe_class = recipe.__class__
+        qualified = '%s:%s' % (recipe_class.__module__, recipe_class.__name__)
+    if configured is None or configured == qualified:
+        return (qualified,)
+    return (configured, qualified)
+
+
+class RecipeIndex(object):
+    """Index of a recipe tree, to evaluate selectors.
+
+    Build it once per parsed tree, then call :py:meth:`select` as many times
+    as needed.
+
+    """
+    def __init__(self, root):
+        """Constructor."""
+        self.root = root
+        self.entries = []  # (path relative to root, recipe) tuples.
+        self.by_name = {}  # Entries per recipe name.
+        prefix = root.path + '/'
+        for recipe in walk(root):
+            if recipe.path.startswith(prefix):
+                entry = (recipe.path[len(prefix):] + '/', recipe)
+            else:
+                entry = ('', recipe)
+            self.entries.append(entry)
+            self.by_name.setdefault(recipe.name, []).append(entry)
+
+    def match(self, selector):
+        """Return list of recipes matching selector."""
+        selector = selector.strip()
+        if '=' in selector:
+            (key, pattern) = [item.strip() for item in selector.split('=', 1)]
+            if key == 'recipe':
+                return [recipe for (path, recipe) in self.entries
+                        if any(fnmatchcase(value, pattern)
+                               for value in factory_strings(recipe))]
+            return [recipe for (path, recipe) in self.entries
+                    if fnmatchcase(self.get_attribute(recipe, key), pattern)]
+        regex = compile_path_pattern(selector)
+        entries = self.entries
+        last = selector.rstrip('/').rpartition('/')[2]
+        if last and not set('*?[') & set(last):
+            entries = self.by_name.get(last, [])
+        return [recipe for (path, recipe) in entries if regex.match(path)]
+
+    def get_attribute(self, recipe, key):
+        """Return value of attribute ``key`` of recipe, for selectors."""
+        if key == 'recipe':
+            return factory_strings(recipe)[0]
+        if key == 'name':
+            return recipe.name
+        options = recipe.options
+        try:
+            if isinstance(options, Options):
+                return options.raw(key)
+            return options[key]
+        except KeyError:
+            return ''
+
+    def select(self, selectors):
+        """Return :py:class:`Selection` of recipes matching any selector.
+
+        ``selectors`` is a list of selectors. Items can hold several
+        selectors, separated by ",".
+
+        """
+        paths = []
+        for item in selectors:
+            for selector in item.split(','):
+                if selector.strip():
+                    paths.extend(recipe.path
+                                 for recipe in self.match(selector))
+        return Selection(paths)
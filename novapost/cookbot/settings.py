@@ -1,8 +1,15 @@
 """Build :py:class:`Recipe` tree from configuration files."""
-from ConfigParser import ConfigParser, NoOptionError
+from ConfigParser import (ConfigParser, DEFAULTSECT,
+                          InterpolationDepthError,
+                          InterpolationMissingOptionError,
+                          MAX_INTERPOLATION_DEPTH,
+                          MissingSectionHeaderError, NoOptionError,
+                          NoSectionError, ParsingError)
 import re
 
 from context import Context
+from registry import LazyRecipe, registry
+from templates import FrozenOptions
 
 
 DEFAULT_RECIPE = 'novapost.cookbot.recipes:Recipe'
@@ -18,11 +25,22 @@ class ConfigParserReader(object):
        http://docs.python.org/library/configparser.html
 
     """
-    def __init__(self, file_object, context=Context()):
-        """Constructor."""
+    def __init__(self, file_object, context=Context(), registry=registry,
+                 lazy=False):
+        """Constructor.
+
+        Recipe factories are resolved with ``registry``, a
+        :py:class:`~novapost.cookbot.registry.FactoryRegistry`. If ``lazy`` is
+        True, recipes are :py:class:`~novapost.cookbot.registry.LazyRecipe`
+        proxies: recipe modules are imported when recipes are used.
+
+        """
         self.file_object = file_object
         self.parser = None
         self.context = context
+        self.registry = registry
+        self.lazy = lazy
+        self.sections = {}  # Options per section, shared by recipes.
 
     def load_recipe(self, factory_string, name, options):
         """Import recipe factory, return recipe instance.
@@ -30,7 +48,8 @@ class ConfigParserReader(object):
         Recipe factory is a string representing the path to a Python module
         and an attribute in this module, separated with a ":" character.
         As an example, ``novapost.cookbot.recipes:Recipe`` is the
-        default.
+        default. It can also be a name registered in :py:attr:`registry`,
+        e.g. an entry point.
 
         ``name`` and ``options`` arguments will be passed to recipe's factory.
 
@@ -39,32 +58,56 @@ class ConfigParserReader(object):
         and returns a :py:class:`Recipe` instance (or compatible).
 
         """
-        # Import recipe factory.
-        (path, factory_name) = factory_string.split(':')
-        mod = __import__(path, globals(), locals(), [factory_name], -1)
-        factory = getattr(mod, factory_name)
+        if self.lazy:
+            return LazyRecipe(self.registry, factory_string, self.context,
+                              name, options)
+        factory = self.registry.resolve(factory_string)
         # Instanciate recipe.
         recipe = factory(self.context, name, options)
+        recipe.factory_string = factory_string
         return recipe
 
-    def parse_section(self, name):
+    def parse_section(self, name, parent_path=None):
         """Parse ``name`` configuration section recursively and return recipe
         instance.
 
         Each section is supposed to describe a recipe.
 
+        Recipe's path is ``parent_path`` and ``name`` joined with "/".
+
         """
-        options = dict(self.parser.items(name))
+        options = self.get_options(name)
         factory_string = self._get_string(name, 'recipe', DEFAULT_RECIPE)
         recipe = self.load_recipe(factory_string, name, options)
+        if parent_path is not None:
+            recipe.path = '%s/%s' % (parent_path, name)
         requirements = self._get_list(name, 'requires')
-        recipe.requirements = [self.parse_section(req) for req in requirements]
+        recipe.requirements = [self.parse_section(req, recipe.path)
+                               for req in requirements]
         parts = self._get_list(name, 'parts')
-        recipe.parts = [self.parse_section(part) for part in parts]
+        recipe.parts = [self.parse_section(part, recipe.path)
+                        for part in parts]
         return recipe
 
+    def get_options(self, name):
+        """Return options of section ``name``.
+
+        Options are read once per section, then shared by every recipe of this
+        section. Keys and values are interned.
+
+        """
+        try:
+            return self.sections[name]
+        except KeyError:
+            pass
+        options = FrozenOptions((_intern(key), _intern(value))
+                                for key, value in self.parser.items(name))
+        self.sections[name] = options
+        return options
+
     def parse(self, section='main'):
         """Parse self.file_object and return root recipe."""
+        self.sections = {}
         self.parser = ConfigParser()
         self.parser.readfp(self.file_object)
         root_recipe = self.parse_section(section)
@@ -97,3 +140,198 @@ class ConfigParserReader(object):
             else:
                 value = default
         return value
+
+
+#: Section header, as in :py:class:`ConfigParser.ConfigParser`.
+SECTION_PATTERN = re.compile(r'\[(?P<header>[^]]+)\]')
+#: Interpolation keys, as in :py:class:`ConfigParser.ConfigParser`.
+INTERPOLATION_PATTERN = re.compile(r'%\(([^)]*)\)s')
+
+
+def tokenize(file_object, name='<???>'):
+    """Read configuration file once, return (defaults, sections) tuple.
+
+    ``defaults`` is the dictionary of options in DEFAULT section. ``sections``
+    is a dictionary of raw (i.e. not interpolated) options per section.
+
+    Syntax is the one of :py:class:`ConfigParser.ConfigParser`.
+
+    >>> from cStringIO import StringIO
+    >>> (defaults, sections) = tokenize(StringIO('''
+    ... [DEFAULT]
+    ... user = me
+    ... [main]
+    ... parts =
+    ...     a
+    ...     b
+    ... Home: /home/%(user)s ; comment
+    ... '''))
+    >>> defaults
+    {'user': 'me'}
+    >>> sorted(sections['main'].items())
+    [('__name__', 'main'), ('home', '/home/%(user)s'), ('parts', '\\na\\nb')]
+
+    """
+    defaults = {}
+    sections = {}
+    current = None  # Options of current section.
+    option = None  # Current option.
+    error = None
+    for (line_number, line) in enumerate(file_object, 1):
+        # Comments and blank lines.
+        if line.strip() == '' or line[0] in '#;':
+            continue
+        if line[0] in 'rR' and line.split(None, 1)[0].lower() == 'rem':
+            continue
+        # Continuation lines.
+        if line[0].isspace() and current is not None and option:
+            value = line.strip()
+            if value:
+                current[option].append(value)
+            continue
+        # Section headers.
+        match = line[0] == '[' and SECTION_PATTERN.match(line)
+        if match:
+            section = match.group('header')
+            if section in sections:
+                current = sections[section]
+            elif section == DEFAULTSECT:
+                current = defaults
+            else:
+                current = sections[section] = {'__name__': section}
+            option = None
+        elif current is None:
+            raise MissingSectionHeaderError(name, line_number, line)
+        else:
+            # Options, i.e. "name = value" or "name: value".
+            position = line.find('=')
+            colon = line.find(':', 0, position) if position > 0 \
+                else line.find(':')
+            if colon != -1:
+                position = colon
+            if position > 0 and not line[0].isspace() \
+               and line[0] not in ':=':
+                option = line[:position].rstrip().lower()
+                value = line[position + 1:]
+                if value.endswith('\n'):
+                    value = value[:-1]
+                value = value.lstrip()
+                if ';' in value:
+                    position = value.find(';')
+                    if value[position - 1].isspace():
+                        value = value[:position]
+                value = value.strip()
+                if value == '""':
+                    value = ''
+                current[option] = [value]
+            else:
+                if not error:
+                    error = ParsingError(name)
+                error.append(line_number, repr(line))
+    if error:
+        raise error
+    for options in [defaults] + sections.values():
+        for key, value in options.items():
+            if isinstance(value, list):
+                options[key] = '\n'.join(value)
+    return (defaults, sections)
+
+
+def interpolate(section, option, value, values):
+    """Return value with ``%(name)s`` interpolations expanded, as
+    :py:meth:`ConfigParser.ConfigParser.get` does."""
+    depth = MAX_INTERPOLATION_DEPTH
+    while depth:
+        depth -= 1
+        if value and '%(' in value:
+            value = INTERPOLATION_PATTERN.sub(_lower_key, value)
+            try:
+                value = value % values
+            except KeyError, e:
+                raise InterpolationMissingOptionError(option, section, value,
+                                                      e.args[0])
+        else:
+            break
+    if value and '%(' in value:
+        raise InterpolationDepthError(option, section, value)
+    return value
+
+
+def _lower_key(match):
+    """Lowercase interpolation key, as ConfigParser does."""
+    return '%%(%s)s' % match.group(1).lower()
+
+
+class FastConfigReader(ConfigParserReader):
+    """Read configuration with the syntax of :py:mod:`ConfigParser`, faster.
+
+    Configuration file is tokenized once into an immutable table of options
+    per section (see :py:func:`tokenize`). Options of a section are
+    interpolated once, no matter how many times the section is referenced.
+    Lists are split without regular expressions.
+
+    Produces the same recipe tree as :py:class:`ConfigParserReader`.
+
+    """
+    def __init__(self, file_object, context=Context(), registry=registry,
+                 lazy=False):
+        """Constructor."""
+        super(FastConfigReader, self).__init__(file_object, context, registry,
+                                               lazy)
+        self.defaults = {}  # Raw options of DEFAULT section.
+        self.table = {}  # Raw options per section.
+
+    def parse(self, section='main'):
+        """Parse self.file_object and return root recipe."""
+        self.sections = {}
+        name = getattr(self.file_object, 'name', '<???>')
+        (defaults, table) = tokenize(self.file_object, name)
+        self.defaults = FrozenOptions(defaults)
+        self.table = dict((key, FrozenOptions(value))
+                          for key, value in table.iteritems())
+        return self.parse_section(section)
+
+    def get_options(self, name):
+        """Return interpolated options of section ``name``, see
+        :py:meth:`ConfigParserReader.get_options`."""
+        try:
+            return self.sections[name]
+        except KeyError:
+            pass
+        try:
+            raw = self.table[name]
+        except KeyError:
+            raise NoSectionError(name)
+        values = dict(self.defaults)
+        values.update(raw)
+        options = FrozenOptions(
+            (_intern(key), _intern(interpolate(name, key, value, values)))
+            for key, value in values.iteritems() if key != '__name__')
+        self.sections[name] = options
+        return options
+
+    def _get_list(self, section, option, is_required=False):
+        """Return option of section as a list of strings."""
+        try:
+            value = self.get_options(section)[option]
+        except KeyError:
+            if is_required:
+                raise NoOptionError(option, section)
+            return []
+        return value.split()
+
+    def _get_string(self, section, option, default=None):
+        """Return option of section as a string."""
+        try:
+            return self.get_options(section)[option]
+        except KeyError:
+            if default is None:
+                raise NoOptionError(option, section)
+            return default
+
+
+def _intern(value):
+    """Return interned value if value is a string, else value."""
+    if type(value) is str:
+        return intern(value)
+    return value
@@ -0,0 +1,351 @@
+"""Interpolate recipe options with :py:class:`~novapost.cookbot.context.Context`
+values."""
+import re
+
+
+#: Matches ``${key}``, ``${key.attribute}`` and the ``$$`` escape sequence.
+PLACEHOLDER_PATTERN = re.compile(r'\$(?:\$|\{([^}\s]+)\})')
+
+
+class InterpolationError(Exception):
+    """Raised when a placeholder cannot be resolved against the context.
+
+    Unlike a missing option, this is not a :py:class:`KeyError`, so that
+    ``options.get()`` does not mistake it for a missing option.
+
+    """
+    def __init__(self, option, placeholder, error):
+        """Constructor.
+
+        ``option`` is the name of the option (None if unknown),
+        ``placeholder`` the unresolved placeholder, e.g. "${machine.ip}", and
+        ``error`` the exception raised by the lookup.
+
+        """
+        if option is None:
+            message = 'Cannot interpolate %s: %r' % (placeholder, error)
+        else:
+            message = 'Cannot interpolate %s in option %r: %r' % (
+                placeholder, option, error)
+        super(InterpolationError, self).__init__(message)
+        self.option = option
+        self.placeholder = placeholder
+        self.error = error
+
+
+class Template(object):
+    """Option template, compiled once, rendered against a context.
+
+    Templates contain placeholders such as ``${user}`` or ``${machine.ip}``.
+    The first part of a placeholder is a context key. Following parts are
+    looked up as items, then as attributes, of the context value. Use ``$$``
+    for a litteral ``$``.
+
+    >>> template = Template('/home/${user}/${machine.name}')
+    >>> sorted(template.references)
+    ['machine', 'user']
+    >>> template.render({'user': 'me', 'machine': {'name': 'www'}})
+    '/home/me/www'
+    >>> Template('$$HOME is ${user}').render({'user': 'me'})
+    '$HOME is me'
+    >>> try:
+    ...     template.render({'user': 'me'}, 'home')
+    ... except InterpolationError, e:
+    ...     print e
+    Cannot interpolate ${machine.name} in option 'home': KeyError('machine',)
+
+    """
+    def __init__(self, source):
+        """Constructor."""
+        self.source = source
+        #: List of litteral strings and lookups, in order. Lookups are tuples
+        #: of names, e.g. ``('machine', 'ip')`` for ``${machine.ip}``.
+        self.chunks = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(source):
+            litteral = source[position:match.start()]
+            if match.group(1) is None:
+                litteral += '$'
+            if litteral:
+                self.chunks.append(litteral)
+            if match.group(1) is not None:
+                self.chunks.append(tuple(match.group(1).split('.')))
+            position = match.end()
+        if source[position:]:
+            self.chunks.append(source[position:])
+        #: Lookups of the template, e.g. ``('machine', 'ip')``.
+        self.lookups = frozenset(chunk for chunk in self.chunks
+                                 if isinstance(chunk, tuple))
+        #: Context keys the template depends on.
+        self.references = frozenset(lookup[0] for lookup in self.lookups)
+
+    def render(self, context, option=None):
+        """Return template rendered against context.
+
+        Raise :py:class:`InterpolationError` if a placeholder cannot be
+        resolved. ``option`` is the name of the option, for error messages.
+
+        """
+        output = []
+        for chunk in self.chunks:
+            if isinstance(chunk, tuple):
+                try:
+                    chunk = '%s' % resolve(context, chunk)
+                except (KeyError, IndexError, AttributeError), e:
+                    raise InterpolationError(option,
+                                             '${%s}' % '.'.join(chunk), e)
+            output.append(chunk)
+        return ''.join(output)
+
+
+def resolve(context, names):
+    """Return value of ``names`` lookup in context.
+
+    >>> resolve({'machine': {'ip': '10.0.0.1'}}, ('machine', 'ip'))
+    '10.0.0.1'
+
+    """
+    value = context[names[0]]
+    for name in names[1:]:
+        try:
+            value = value[name]
+        except (TypeError, KeyError, IndexError, AttributeError):
+            value = getattr(value, name)
+    return value
+
+
+def compile_template(source):
+    """Return :py:class:`Template` for ``source``, or None if ``source`` is not
+    a string or contains no placeholder.
+
+    Templates are not memoized here: options keep the templates of their
+    values, see :py:meth:`Options.template`.
+
+    >>> compile_template('/home') is None
+    True
+
+    """
+    if not isinstance(source, basestring) or '$' not in source:
+        return None
+    template = Template(source)
+    if not template.references and template.chunks == [source]:
+        return None
+    return template
+
+
+class FrozenDict(dict):
+    """Read-only dictionary, shared until copied.
+
+    >>> commands = FrozenDict({'install': None})
+    >>> commands.update({'status': None})
+    Traceback (most recent call last):
+    ...
+    TypeError: FrozenDict instances are read-only.
+
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s instances are read-only.' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+class FrozenOptions(FrozenDict):
+    """Read-only dictionary of options.
+
+    Configuration readers pass the same instance to every recipe built from a
+    given section. :py:class:`Options` shares it until it is modified, and
+    so the compiled templates of its values (:py:attr:`templates`).
+
+    >>> options = FrozenOptions({'a': '1'})
+    >>> options['a'] = '2'
+    Traceback (most recent call last):
+    ...
+    TypeError: FrozenOptions instances are read-only.
+
+    """
+    __slots__ = ('templates',)
+
+    def __init__(self, *args, **kwargs):
+        """Constructor."""
+        super(FrozenOptions, self).__init__(*args, **kwargs)
+        #: Compiled template (or None) per key, see Options.template().
+        self.templates = {}
+
+
+class Options(object):
+    """Dictionary of recipe options, with lazy interpolation of templates.
+
+    Values are interpolated when accessed, against the recipe's current
+    context. Unresolvable placeholders raise :py:class:`InterpolationError`.
+    Rendered values are memoized until one of the context keys they
+    reference is set, pushed or popped (see
+    :py:meth:`~novapost.cookbot.context.Context.version`).
+
+    :py:class:`FrozenOptions` values and their compiled templates are shared,
+    i.e. not copied until options are modified.
+
+    """
+    __slots__ = ('recipe', 'data', 'templates', 'cache')
+
+    def __init__(self, recipe, values=None):
+        """Constructor."""
+        self.recipe = recipe
+        self.cache = None  # (context, versions, rendered value), per key.
+        if isinstance(values, FrozenOptions):
+            self.data = values  # Raw values.
+            self.templates = values.templates
+        else:
+            self.data = {}
+            self.templates = {}
+            if values:
+                self.update(values)
+
+    def template(self, key):
+        """Return compiled template of value at key, or None if the value is
+        not a template.
+
+        Templates are compiled once per value, and shared with
+        :py:class:`FrozenOptions`, i.e. compiled once per configuration
+        section.
+
+        """
+        try:
+            return self.templates[key]
+        except KeyError:
+            template = compile_template(self.data[key])
+            self.templates[key] = template
+            return template
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        if not isinstance(value, basestring) or '$' not in value:
+            return value
+        template = self.template(key)
+        if template is None:
+            return value
+        context = self.recipe.context
+        versions = tuple(context.version(name) for name in template.references)
+        if self.cache is None:
+            self.cache = {}
+        else:
+            try:
+                (cached_context, cached_versions, value) = self.cache[key]
+            except KeyError:
+                pass
+            else:
+                if cached_context is context and cached_versions == versions:
+                    return value
+        value = template.render(context, key)
+        self.cache[key] = (context, versions, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if isinstance(self.data, FrozenOptions):
+            self.data = dict(self.data)
+            self.templates = dict(self.templates)
+        self.templates.pop(key, None)
+        self.data[key] = value
+        if self.cache:
+            self.cache.pop(key, None)
+
+    def __delitem__(self, key):
+        if isinstance(self.data, FrozenOptions):
+            self.data = dict(self.data)
+            self.templates = dict(self.templates)
+        self.templates.pop(key, None)
+        del self.data[key]
+        if self.cache:
+            self.cache.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.data)
+
+    def get(self, key, default=None):
+        """Return interpolated value at key if any, else default."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        return key in self.data
+
+    def setdefault(self, key, default=None):
+        """Set key to default if missing. Return (interpolated) value."""
+        if key not in self.data:
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        """Return options with the same raw values, for the same recipe."""
+        return self.__class__(self.recipe, self.data)
+
+    def clear(self):
+        """Remove all options."""
+        self.data = {}
+        self.templates = {}
+        self.cache = None
+
+    def keys(self):
+        return list(self.data)
+
+    def iterkeys(self):
+        return iter(self.data)
+
+    def values(self):
+        return [self[key] for key in self.data]
+
+    def itervalues(self):
+        return (self[key] for key in self.data)
+
+    def items(self):
+        return [(key, self[key]) for key in self.data]
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.data)
+
+    def update(self, values):
+        """Set several values at once, from a dictionary."""
+        for key, value in values.items():
+            self[key] = value
+
+    def pop(self, key, *default):
+        """Remove key and return its (interpolated) value."""
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self):
+        """Remove an option and return (key, interpolated value) tuple."""
+        try:
+            key = next(iter(self.data))
+        except StopIteration:
+            raise KeyError('popitem(): dictionary is empty')
+        return (key, self.pop(key))
+
+    def raw(self, key):
+        """Return value at key, without interpolation."""
+        return self.data[key]
@@ -1,10 +1,171 @@
 """Unit tests."""
+from ConfigParser import (InterpolationMissingOptionError,
+                          MissingSectionHeaderError, NoSectionError,
+                          ParsingError)
 from cStringIO import StringIO
+import json
+import os
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
+from cache import ResultCache
+from command import Command
 from context import Context
-from settings import ConfigParserReader
-from recipes import Recipe
+from dryrun import DryRun
+from events import EventLog
+from locks import LockManager
+from metrics import MetricsCollector
+from profiling import Profiler
+from settings import ConfigParserReader, FastConfigReader
+from templates import FrozenOptions, InterpolationError
+from recipes import MachineRecipe, Recipe
+from registry import FactoryRegistry, LazyRecipe
+from reverse import ReverseExecutor, TeardownError
+from selection import RecipeIndex, Selection, walk
+from timeouts import RecipeTimeout, watchdog
+from transports import (CommandError, LocalTransport, Session, SessionPool,
+                        TransportError, run_subprocess)
+from watch import Watcher
+
+
+CONFIGURATION = """
+# Main configuration part.
+[main]
+parts =
+    dev
+    staging
+    prod
+
+# Environments and machines.
+
+# Dev environment.
+[dev]
+parts = dev-machine
+
+[dev-machine]
+parts =
+    www
+    media
+    db
+
+# Staging environment.
+[staging]
+parts =
+    staging-front
+    staging-db
+
+[staging-front]
+parts =
+    www
+    media
+
+[staging-db]
+parts = db
+
+# Prod environment.
+[prod]
+parts =
+    prod-www
+    prod-media
+    prod-db
+
+[prod-www]
+parts = www
+
+[prod-media]
+parts = media
+
+[prod-db]
+parts = db
+
+# Components.
+
+[www]
+parts =
+    nginx
+    django
+
+[media]
+parts =
+    nginx
+
+[db]
+parts = postgresql
+
+# Recipes.
+
+[nginx]
+recipe = novapost.cookbot.recipes:Recipe
+
+[django]
+recipe = novapost.cookbot.recipes:Recipe
+
+[postgresql]
+recipe = novapost.cookbot.recipes:Recipe
+
+"""
+
+
+EXECUTION_ORDER_CONFIGURATION = """
+# Main configuration part.
+[main]
+recipe = novapost.cookbot.tests:TrackerRecipe
+requires = Part0
+parts =
+    Part3
+    Part6
+
+[Part0]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+[Part3]
+recipe = novapost.cookbot.tests:TrackerRecipe
+requires = Part1
+
+[Part1]
+recipe = novapost.cookbot.tests:TrackerRecipe
+parts = Part2
+
+[Part2]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+[Part6]
+recipe = novapost.cookbot.tests:TrackerRecipe
+requires =
+    Part4
+    Part5
+parts =
+    Part7
+    Part8
+
+[Part4]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+[Part5]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+[Part7]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+[Part8]
+recipe = novapost.cookbot.tests:TrackerRecipe
+
+"""
+
+
+def parse_configuration(contents, section='main'):
+    """Return recipe tree parsed from configuration contents."""
+    configuration_file = StringIO()
+    configuration_file.write(contents)
+    configuration_file.seek(0)
+    reader = ConfigParserReader(configuration_file)
+    return reader.parse(section)
 
 
 class TrackerRecipe(Recipe):
@@ -114,6 +275,7 @@ recipe = novapost.cookbot.recipes:Recipe
         reader.parse()
 
 
+
 class CmdTestCase(TestCase):
     """Test execution of recipes."""
     def test_execution_order(self):
@@ -242,3 +404,1361 @@ recipe = novapost.cookbot.tests:TrackerRecipe
                             'ExitPart0',
                             ]
         self.assertEqual(recipe.context['testing'], expected_context)
+
+    def test_multiple_commands(self):
+        """Several commands run in a single traversal of the tree."""
+        recipe = parse_configuration(EXECUTION_ORDER_CONFIGURATION)
+        context = Context()
+        context['testing'] = []
+        recipe.execute(context, ['install', 'update'])
+        expected_context = ['InstallPart0',
+                            'EnterPart0',
+                            'UpdatePart0',
+                            'Installmain',
+                            'Entermain',
+                            'Updatemain',
+                            'InstallPart1',
+                            'EnterPart1',
+                            'UpdatePart1',
+                            'InstallPart2',
+                            'EnterPart2',
+                            'UpdatePart2',
+                            'InstallPart3',
+                            'EnterPart3',
+                            'UpdatePart3',
+                            'ExitPart3',
+                            'ExitPart2',
+                            'ExitPart1',
+                            'InstallPart4',
+                            'EnterPart4',
+                            'UpdatePart4',
+                            'InstallPart5',
+                            'EnterPart5',
+                            'UpdatePart5',
+                            'InstallPart6',
+                            'EnterPart6',
+                            'UpdatePart6',
+                            'InstallPart7',
+                            'EnterPart7',
+                            'UpdatePart7',
+                            'ExitPart7',
+                            'InstallPart8',
+                            'EnterPart8',
+                            'UpdatePart8',
+                            'ExitPart8',
+                            'ExitPart6',
+                            'ExitPart5',
+                            'ExitPart4',
+                            'Exitmain',
+                            'ExitPart0',
+                            ]
+        self.assertEqual(context['testing'], expected_context)
+        # Entering before 'install' when another command comes first.
+        context = Context()
+        context['testing'] = []
+        recipe.parts[0].execute(context, ['update', 'install'])
+        expected_context = ['EnterPart1',
+                            'UpdatePart1',
+                            'InstallPart1',
+                            'EnterPart2',
+                            'UpdatePart2',
+                            'InstallPart2',
+                            'EnterPart3',
+                            'UpdatePart3',
+                            'InstallPart3',
+                            'ExitPart3',
+                            'ExitPart2',
+                            'ExitPart1',
+                            ]
+        self.assertEqual(context['testing'], expected_context)
+
+
+class OptionsTestCase(TestCase):
+    """Test interpolation of recipe options."""
+    def test_interpolation(self):
+        """Options are interpolated with recipe's context when read."""
+        context = Context()
+        context['user'] = 'me'
+        context['machine'] = {'ip': '10.0.0.1'}
+        recipe = Recipe(context, 'test', {'home': '/home/${user}',
+                                          'url': 'http://${machine.ip}/',
+                                          'plain': 'value'})
+        self.assertEqual(recipe.options['home'], '/home/me')
+        self.assertEqual(recipe.options['url'], 'http://10.0.0.1/')
+        self.assertEqual(recipe.options['plain'], 'value')
+        self.assertEqual(recipe.options.raw('home'), '/home/${user}')
+        context.push('user')
+        context['user'] = 'you'
+        self.assertEqual(recipe.options['home'], '/home/you')
+        context.pop('user')
+        self.assertEqual(recipe.options['home'], '/home/me')
+
+    def test_memoization(self):
+        """Rendered values are reused until referenced keys change."""
+        context = Context()
+        context['user'] = 'me'
+        context['machine'] = {'ip': '10.0.0.1'}
+        recipe = Recipe(context, 'test', {'home': '/home/${user}',
+                                          'url': 'http://${machine.ip}/'})
+        home = recipe.options['home']
+        url = recipe.options['url']
+        self.assertTrue(recipe.options['home'] is home)
+        context.push('user')
+        context['user'] = 'you'
+        self.assertFalse(recipe.options['home'] is home)
+        self.assertTrue(recipe.options['url'] is url)
+
+    def test_interpolation_error(self):
+        """Unresolvable placeholders are errors, not missing options."""
+        context = Context()
+        context['machine'] = {'name': 'www'}
+        recipe = Recipe(context, 'test', {'timeout': '${t}',
+                                          'url': 'http://${machine.ip}/',
+                                          'name': '${machine.name.short}'})
+        for (option, placeholder) in [('timeout', '${t}'),
+                                      ('url', '${machine.ip}'),
+                                      ('name', '${machine.name.short}')]:
+            try:
+                recipe.options.get(option)
+            except InterpolationError, e:
+                self.assertEqual(e.option, option)
+                self.assertEqual(e.placeholder, placeholder)
+                self.assertTrue(placeholder in str(e))
+            else:
+                self.fail('%s did not raise InterpolationError' % option)
+        context['timeout'] = 10
+        self.assertRaises(InterpolationError, recipe.get_timeout)
+
+    def test_dict_api(self):
+        """Options implement the dictionary API."""
+        context = Context()
+        context['user'] = 'me'
+        options = FrozenOptions({'home': '/home/${user}'})
+        recipe = Recipe(context, 'test', options)
+        self.assertTrue(recipe.options.has_key('home'))
+        self.assertEqual(recipe.options.setdefault('home', 'x'), '/home/me')
+        self.assertEqual(recipe.options.setdefault('shell', '${user}sh'),
+                         'mesh')
+        copy = recipe.options.copy()
+        copy['home'] = '/'
+        self.assertEqual(copy, {'home': '/', 'shell': 'mesh'})
+        self.assertEqual(recipe.options['home'], '/home/me')
+        (key, value) = recipe.options.popitem()
+        self.assertEqual(value, {'home': '/home/me', 'shell': 'mesh'}[key])
+        self.assertFalse(key in recipe.options)
+        recipe.options.clear()
+        self.assertEqual(len(recipe.options), 0)
+        self.assertRaises(KeyError, recipe.options.popitem)
+        self.assertEqual(options, {'home': '/home/${user}'})
+
+    def test_compiled_templates(self):
+        """Templates are compiled once per section, plain values never."""
+        recipe = parse_configuration("""
+[main]
+parts =
+    a
+    b
+
+[a]
+parts = www
+
+[b]
+parts = www
+
+[www]
+home = /home/${user}
+shell = /bin/sh
+""")
+        (www, other_www) = [part.parts[0] for part in recipe.parts]
+        www.context['user'] = 'me'
+        self.assertEqual(www.options['home'], '/home/me')
+        self.assertEqual(other_www.options['shell'], '/bin/sh')
+        self.assertTrue(other_www.options.template('home')
+                        is www.options.template('home'))
+        self.assertEqual(www.options.templates.keys(), ['home'])
+        www.options['home'] = '/'
+        self.assertEqual(other_www.options.templates.keys(), ['home'])
+
+
+class ContextTestCase(TestCase):
+    """Test change tracking of novapost.cookbot.context.Context."""
+    def test_versions(self):
+        """Every change of a stack increments its version."""
+        context = Context()
+        versions = [context.version('a')]
+        context['a'] = 1
+        versions.append(context.version('a'))
+        context.push('a')
+        versions.append(context.version('a'))
+        context.pop('a')
+        versions.append(context.version('a'))
+        del context['a']
+        versions.append(context.version('a'))
+        self.assertEqual(versions, sorted(set(versions)))
+        context['b'] = 1
+        self.assertEqual(context.version('a'), versions[-1])
+
+    def test_watchers(self):
+        """Watchers receive events for the keys they watch."""
+        context = Context()
+        events = []
+        context.watch(lambda key, event: events.append((key, event)))
+        context.push('a')
+        context['a'] = 1
+        context.pop('a')
+        self.assertEqual(events, [('a', 'push'), ('a', 'set'), ('a', 'pop')])
+
+    def test_enter_context_changes(self):
+        """Recipe.enter() records changes made by enter_context()."""
+        class UserRecipe(Recipe):
+            def enter_context(self):
+                self.context.push('user')
+                self.context['user'] = 'you'
+
+        context = Context()
+        context['user'] = 'me'
+        context['other'] = 'value'
+        recipe = UserRecipe(context, 'test', {})
+        recipe.enter()
+        self.assertEqual(recipe.context_changes, {'user': 'you'})
+
+
+class HangingRecipe(Recipe):
+    """A recipe which never completes update()."""
+    def update(self):
+        while True:
+            time.sleep(0.01)
+
+    def cancel(self, cmd):
+        self.context['cancelled'].append(cmd)
+
+
+class SleepCommandRecipe(Recipe):
+    """A recipe which runs "sleep" with its transport."""
+    def update(self):
+        self.context['transport'].run(['sleep', '5'])
+
+
+class CleanupRecipe(HangingRecipe):
+    """A recipe which runs a guarded command in another thread on cancel."""
+    def cancel(self, cmd):
+        def cleanup():
+            with watchdog.guard(self, 'cleanup', 1):
+                self.context['cancelled'].append(cmd)
+
+        cleanup_thread = threading.Thread(target=cleanup)
+        cleanup_thread.start()
+        cleanup_thread.join()
+
+
+class TimeoutTestCase(TestCase):
+    """Test timeout of commands."""
+    def setUp(self):
+        self.stream = StringIO()
+        watchdog.stream = self.stream
+
+    def tearDown(self):
+        watchdog.stream = None
+
+    def test_timeout_option(self):
+        """Commands exceeding "timeout" option are interrupted."""
+        context = Context()
+        context['cancelled'] = []
+        recipe = HangingRecipe(context, 'hanging', {'timeout': '0.1'})
+        try:
+            recipe.execute(context, 'update')
+        except RecipeTimeout, e:
+            self.assertEqual(e.recipe_name, 'hanging')
+            self.assertEqual(e.cmd, 'update')
+            self.assertTrue('in update' in e.stack)
+        else:
+            self.fail('RecipeTimeout not raised.')
+        self.assertEqual(context['cancelled'], ['update'])
+        self.assertTrue('in update' in self.stream.getvalue())
+
+    def test_default_timeout(self):
+        """Context's "timeout" is the default, fast commands complete."""
+        context = Context()
+        context['cancelled'] = []
+        context['timeout'] = 0.1
+        recipe = HangingRecipe(context, 'hanging', {})
+        recipe.execute(context, 'install')
+        time.sleep(0.2)
+        self.assertRaises(RecipeTimeout, recipe.execute, context, 'update')
+
+    def test_cancel_outside_lock(self):
+        """Recipes can use the watchdog while being cancelled."""
+        context = Context()
+        context['cancelled'] = []
+        recipe = CleanupRecipe(context, 'hanging', {'timeout': '0.1'})
+        self.assertRaises(RecipeTimeout, recipe.execute, context, 'update')
+        self.assertEqual(context['cancelled'], ['update'])
+
+    def test_kill_subprocess(self):
+        """Subprocesses of local transport are killed on timeout."""
+        machine = MachineRecipe(Context(), 'machine', {})
+        machine.parts = [SleepCommandRecipe(Context(), 'sleep',
+                                            {'timeout': '0.1'})]
+        start = time.time()
+        self.assertRaises(RecipeTimeout, machine.execute, Context(),
+                          'update')
+        self.assertTrue(time.time() - start < 2)
+
+
+class CompactRecipeTestCase(TestCase):
+    """Test memory-saving features of recipes."""
+    def test_shared_commands(self):
+        """Exposed commands are shared until expose() is called."""
+        first = Recipe(Context(), 'first', {})
+        second = Recipe(Context(), 'second', {})
+        self.assertTrue(first.exposed_commands is second.exposed_commands)
+        self.assertRaises(TypeError, first.exposed_commands.__setitem__,
+                          'status', None)
+
+        class StatusRecipe(Recipe):
+            default_exposed_commands = {'status': None}
+
+        recipe = StatusRecipe(Context(), 'status', {})
+        self.assertRaises(TypeError, recipe.exposed_commands.__setitem__,
+                          'install', None)
+        second.expose('status')
+        self.assertTrue(second.is_exposed('status'))
+        self.assertFalse(first.is_exposed('status'))
+        self.assertFalse(hasattr(first, '__dict__'))
+
+    def test_shared_options(self):
+        """Recipes of the same section share options until modified."""
+        recipe = parse_configuration(CONFIGURATION)
+        www = recipe.parts[0].parts[0].parts[0]
+        other_www = recipe.parts[1].parts[0].parts[0]
+        self.assertEqual(www.name, 'www')
+        self.assertEqual(other_www.name, 'www')
+        self.assertTrue(www.options.data is other_www.options.data)
+        www.options['parts'] = 'nginx'
+        self.assertEqual(other_www.options['parts'], '\nnginx\ndjango')
+        self.assertFalse(www.options.data is other_www.options.data)
+
+
+class EchoRecipe(Recipe):
+    """A recipe which runs "echo" with its transport."""
+    __slots__ = ()
+
+    def update(self):
+        result = self.context['transport'].run(['echo', self.options['text']],
+                                               check=True)
+        self.context['testing'].append(result.stdout)
+
+
+class SessionHandler(SocketServer.StreamRequestHandler):
+    """Serve requests of a transports.Session."""
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        for line in iter(self.rfile.readline, ''):
+            request = json.loads(line)
+            result = self.server.handler(request['command'], request['input'])
+            self.wfile.write(json.dumps({'returncode': result.returncode,
+                                         'stdout': result.stdout,
+                                         'stderr': result.stderr}))
+            self.wfile.write('\n')
+            self.wfile.flush()
+
+
+class SessionServer(SocketServer.ThreadingTCPServer):
+    """Local server for transports.Session, for tests.
+
+    Commands are run with ``handler(command, input)``, which defaults to
+    local subprocesses. :py:attr:`connections` counts accepted connections.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), handler=run_subprocess):
+        """Constructor."""
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 SessionHandler)
+        self.handler = handler
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, poll_interval=0.1):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(poll_interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+class TransportTestCase(TestCase):
+    """Test transports and machine recipes."""
+    def setUp(self):
+        self.server = SessionServer()
+        self.server.start()
+        self.pool = SessionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_local_transport(self):
+        """LocalTransport runs subprocesses."""
+        transport = LocalTransport()
+        self.assertEqual(transport.run('echo cookbot | tr c C').stdout,
+                         'Cookbot\n')
+        self.assertRaises(CommandError, transport.run, ['false'], check=True)
+
+    def test_session_reuse(self):
+        """Parts of a machine share sessions."""
+        (host, port) = self.server.server_address
+        machine = MachineRecipe(Context(), 'machine',
+                                {'host': host, 'port': str(port)})
+        machine.parts = [EchoRecipe(Context(), 'part%d' % index,
+                                    {'text': '${machine.host}-%d' % index})
+                         for index in range(3)]
+        context = Context()
+        context['testing'] = []
+        context['session_pool'] = self.pool
+        machine.execute(context, 'update')
+        self.assertEqual(context['testing'], ['%s-%d\n' % (host, index)
+                                              for index in range(3)])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_session_limit(self):
+        """The number of sessions open on a host is capped."""
+        (host, port) = self.server.server_address
+        self.pool.set_limit(host, 1)
+        session = self.pool.acquire(host, port)
+        self.assertRaises(TransportError, self.pool.acquire, host, port,
+                          timeout=0.05)
+        self.pool.release(session)
+        self.assertTrue(self.pool.acquire(host, port, timeout=0.05)
+                        is session)
+        self.pool.release(session)
+
+    def test_cancel_session(self):
+        """Sessions of cancelled commands are closed."""
+        (host, port) = self.server.server_address
+
+        def slow_handler(command, input):
+            time.sleep(2)
+            return run_subprocess(command, input)
+
+        self.server.handler = slow_handler
+        machine = MachineRecipe(Context(), 'machine',
+                                {'host': host, 'port': str(port)})
+        machine.parts = [SleepCommandRecipe(Context(), 'sleep',
+                                            {'timeout': '0.1'})]
+        context = Context()
+        context['session_pool'] = self.pool
+        watchdog.stream = StringIO()
+        start = time.time()
+        try:
+            self.assertRaises(RecipeTimeout, machine.execute, context,
+                              'update')
+        finally:
+            watchdog.stream = None
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.pool.open[host], 0)
+
+    def test_session_timeout(self):
+        """Sessions time out."""
+        (host, port) = self.server.server_address
+
+        def slow_handler(command, input):
+            time.sleep(0.5)
+            return run_subprocess(command, input)
+
+        self.server.handler = slow_handler
+        session = Session(host, port, timeout=0.05)
+        try:
+            self.assertRaises(TransportError, session.execute, 'true')
+        finally:
+            session.close()
+
+
+class PrintRecipe(Recipe):
+    """A recipe which prints its name."""
+    __slots__ = ()
+
+    def update(self):
+        sys.stdout.write('Updating %s\n' % self.name)
+
+
+class SubprocessRecipe(Recipe):
+    """A recipe which runs a subprocess, with standard output."""
+    __slots__ = ()
+
+    def update(self):
+        subprocess.check_call([sys.executable, '-c', 'pass'],
+                              stdout=sys.stdout)
+
+
+class EventLogTestCase(TestCase):
+    """Test novapost.cookbot.events.EventLog."""
+    def test_events(self):
+        """Traversal, commands and output are streamed as JSON lines."""
+        recipe = PrintRecipe(Context(), 'main', {})
+        recipe.parts = [PrintRecipe(Context(), 'part', {})]
+        recipe.parts[0].path = 'main/part'
+        stream = StringIO()
+        event_log = EventLog(stream, tail_size=3, echo=False)
+        context = Context()
+        context['event_log'] = event_log
+        with event_log.redirect_output():
+            recipe.execute(context, ['update', 'status'])
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        summary = [(event['path'], event['phase'], event['command'],
+                    event['status']) for event in events]
+        self.assertEqual(summary[:7],
+                         [('main', 'enter', None, 'start'),
+                          ('main', 'enter', None, 'ok'),
+                          ('main', 'command', 'update', 'start'),
+                          ('main', 'output', 'update', 'ok'),
+                          ('main', 'command', 'update', 'ok'),
+                          ('main', 'command', 'status', 'skipped'),
+                          ('main/part', 'enter', None, 'start')])
+        self.assertEqual(events[3]['chunk'], 'Updating main\n')
+        self.assertTrue(events[4]['duration'] >= 0)
+        self.assertEqual(summary[-1], ('main', 'exit', None, 'ok'))
+        # Only the last events are kept in memory.
+        self.assertEqual(len(event_log.tail), 3)
+        self.assertEqual(event_log.format_tail().splitlines(),
+                         stream.getvalue().splitlines()[-3:])
+
+    def test_subprocess(self):
+        """Redirected output is a file of its own for subprocesses."""
+        recipe = SubprocessRecipe(Context(), 'main', {})
+        event_log = EventLog(StringIO(), echo=False)
+        context = Context()
+        context['event_log'] = event_log
+        with event_log.redirect_output() as redirection:
+            self.assertEqual(redirection.fileno(),
+                             redirection.stdout.fileno())
+            self.assertEqual(redirection.isatty(),
+                             redirection.stdout.isatty())
+            recipe.execute(context, 'update')
+
+    def test_paths(self):
+        """Configuration readers set recipes' paths."""
+        recipe = parse_configuration(CONFIGURATION)
+        self.assertEqual(recipe.path, 'main')
+        self.assertEqual(recipe.parts[0].parts[0].path, 'main/dev/dev-machine')
+
+
+class FailingRecipe(Recipe):
+    """A recipe which fails to update."""
+    __slots__ = ()
+
+    def update(self):
+        raise RuntimeError('Update failed.')
+
+
+class MetricsTestCase(TestCase):
+    """Test novapost.cookbot.metrics.MetricsCollector."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cookbot.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_command_metrics(self):
+        """Command writes metrics of recipes and run."""
+        command = Command()
+        command.recipe = Recipe(Context(), 'main', {})
+        command.recipe.parts = [FailingRecipe(Context(), 'failing', {})]
+        command.cmd = ['install', 'status', 'update']
+        command.metrics = self.path
+        self.assertRaises(RuntimeError, command)
+        self.assertEqual(os.listdir(self.directory), ['cookbot.prom'])
+        with open(self.path) as metrics_file:
+            metrics = metrics_file.read().splitlines()
+        labels = 'section="%s",recipe_class="novapost.cookbot.%s",command="%s"'
+        for line in [
+                '# TYPE cookbot_recipe_commands_total counter',
+                'cookbot_recipe_commands_total{%s,status="executed"} 1'
+                % (labels % ('main', 'recipes:Recipe', 'install')),
+                'cookbot_recipe_commands_total{%s,status="skipped"} 1'
+                % (labels % ('main', 'recipes:Recipe', 'status')),
+                'cookbot_recipe_commands_total{%s,status="failed"} 1'
+                % (labels % ('failing', 'tests:FailingRecipe', 'update')),
+                'cookbot_recipe_command_duration_seconds_count{%s} 1'
+                % (labels % ('main', 'recipes:Recipe', 'update')),
+                'cookbot_runs_total{status="failed"} 1',
+                'cookbot_last_run_success 0']:
+            self.assertTrue(line in metrics, line)
+
+    def test_totals(self):
+        """Counters and histograms count across runs."""
+        command = Command()
+        command.recipe = Recipe(Context(), 'main', {})
+        command.cmd = ['update']
+        command.metrics = self.path
+        for run in range(3):
+            command()
+        with open(self.path) as metrics_file:
+            metrics = metrics_file.read().splitlines()
+        for line in [
+                'cookbot_runs_total{status="succeeded"} 3',
+                'cookbot_run_duration_seconds_bucket{le="+Inf"} 3',
+                'cookbot_run_duration_seconds_count 3',
+                'cookbot_last_run_success 1']:
+            self.assertTrue(line in metrics, line)
+        collector = MetricsCollector(self.path)
+        collector.load()
+        self.assertEqual(collector.render().splitlines(),
+                         [line for line in metrics
+                          if 'cookbot_last_run' not in line])
+
+    def test_histogram(self):
+        """Histograms are rendered with cumulative buckets."""
+        metrics = MetricsCollector(buckets=(1, 10))
+        for value in (0.5, 2, 20):
+            metrics.observe('duration', value)
+        self.assertEqual(metrics.render().splitlines()[2:],
+                         ['duration_bucket{le="1"} 1',
+                          'duration_bucket{le="10"} 2',
+                          'duration_bucket{le="+Inf"} 3',
+                          'duration_sum 22.5',
+                          'duration_count 3'])
+
+
+class SelectionTestCase(TestCase):
+    """Test execution of selected subtrees."""
+    def test_selection(self):
+        """Only selected recipes run commands, ancestors are entered."""
+        recipe = parse_configuration(EXECUTION_ORDER_CONFIGURATION)
+        context = Context()
+        context['testing'] = []
+        recipe.execute(context, 'update',
+                       selection=Selection(['main/Part6/Part7']))
+        self.assertEqual(context['testing'], ['EnterPart0',
+                                              'Entermain',
+                                              'EnterPart4',
+                                              'EnterPart5',
+                                              'EnterPart6',
+                                              'EnterPart7',
+                                              'UpdatePart7',
+                                              'ExitPart7',
+                                              'ExitPart6',
+                                              'ExitPart5',
+                                              'ExitPart4',
+                                              'Exitmain',
+                                              'ExitPart0'])
+
+    def test_selectors(self):
+        """Selectors match paths relative to root, or attributes."""
+        index = RecipeIndex(parse_configuration(CONFIGURATION))
+        self.assertEqual(sorted(index.select(['prod/**/nginx']).paths),
+                         ['main/prod/prod-media/media/nginx',
+                          'main/prod/prod-www/www/nginx'])
+        self.assertEqual(sorted(index.select(['*/dev-machine,**/db']).paths),
+                         ['main/dev/dev-machine',
+                          'main/dev/dev-machine/db',
+                          'main/prod/prod-db/db',
+                          'main/staging/staging-db/db'])
+        self.assertEqual(len(index.select(['*/db'])), 0)
+        self.assertEqual(len(index.select(['name=nginx'])), 6)
+        self.assertEqual(
+            len(index.select(['recipe=novapost.cookbot.recipes:Recipe'])),
+            len(index.entries))
+        self.assertEqual(len(index.select(['recipe=*:MachineRecipe'])), 0)
+
+    def test_recipe_selectors(self):
+        """Recipe selectors match configured and "module:name" factories,
+        with or without lazy recipes."""
+        registry = FactoryRegistry()
+        registry.register('machine', MachineRecipe)
+        for lazy in (False, True):
+            reader = FastConfigReader(StringIO("""
+[main]
+parts = www db
+[www]
+recipe = machine
+[db]
+"""), registry=registry, lazy=lazy)
+            index = RecipeIndex(reader.parse())
+            self.assertEqual(index.select(['recipe=machine']).paths,
+                             frozenset(['main/www']))
+            self.assertEqual(index.select(['recipe=*:MachineRecipe']).paths,
+                             frozenset(['main/www']))
+            self.assertEqual(
+                index.select(['recipe=novapost.cookbot.recipes:Recipe']).paths,
+                frozenset(['main', 'main/db']))
+            if lazy:
+                self.assertTrue(all(recipe.recipe is None
+                                    for (path, recipe) in index.entries))
+
+    def test_select_option(self):
+        """--select option restricts execution to matching recipes."""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cookbot.cfg')
+            with open(path, 'w') as configuration:
+                configuration.write(EXECUTION_ORDER_CONFIGURATION)
+            command = Command()
+            command.parse_shell_args(['-c', path, '--select', 'Part6/Part7',
+                                      'update'])
+            self.assertEqual(command.selection.paths,
+                             frozenset(['main/Part6/Part7']))
+            command = Command()
+            self.assertRaises(SystemExit, command.parse_shell_args,
+                              ['-c', path, '--select', 'unknown', 'update'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class RecordingRecipe(Recipe):
+    """A recipe which records updates in a class attribute."""
+    __slots__ = ()
+    updated = []
+
+    def update(self):
+        self.updated.append(self.name)
+
+
+class WatcherTestCase(TestCase):
+    """Test novapost.cookbot.watch.Watcher."""
+    configuration = """
+[main]
+parts =
+    a
+    b
+[a]
+recipe = novapost.cookbot.tests:RecordingRecipe
+requires = c
+[b]
+recipe = novapost.cookbot.tests:RecordingRecipe
+[c]
+recipe = novapost.cookbot.tests:RecordingRecipe
+value = %s
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cookbot.cfg')
+        self.write_configuration('1')
+        del RecordingRecipe.updated[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_configuration(self, value, mtime=0):
+        with open(self.path, 'w') as configuration_file:
+            configuration_file.write(self.configuration % value)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_changed_section(self):
+        """Changed sections and their dependents run again."""
+        command = Command()
+        command.cfg = self.path
+        command.cmd = ['update']
+        watcher = Watcher(command, debounce=0)
+        self.assertEqual(watcher.check(), None)
+        self.write_configuration('2', mtime=10)
+        self.assertEqual(watcher.check(), set(['a', 'c']))
+        self.assertEqual(RecordingRecipe.updated, ['c', 'a'])
+        self.assertEqual(watcher.check(), None)
+
+
+def slow_helper(count):
+    """A helper shared by recipes."""
+    return sum(range(count))
+
+
+class HelperRecipe(Recipe):
+    """A recipe which calls a shared helper."""
+    __slots__ = ()
+
+    def update(self):
+        slow_helper(1000)
+
+
+class ProfilerTestCase(TestCase):
+    """Test novapost.cookbot.profiling.Profiler."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_selected_sections(self):
+        """Only selected sections are profiled, hotspots are merged."""
+        recipe = Recipe(Context(), 'main', {})
+        recipe.parts = [HelperRecipe(Context(), name, {})
+                        for name in ('first', 'second', 'third')]
+        for part in recipe.parts:
+            part.path = 'main/%s' % part.name
+        profiler = Profiler(self.directory, ['first', 'third'])
+        context = Context()
+        context['profiler'] = profiler
+        recipe.execute(context, 'update')
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['main.first.update.pstats',
+                          'main.third.update.pstats'])
+        hotspots = dict((function[2], count) for (function, _, _, _, count)
+                        in profiler.hotspots())
+        self.assertEqual(hotspots['slow_helper'], 2)
+        stream = StringIO()
+        profiler.report(stream)
+        self.assertTrue('slow_helper' in stream.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'merged.pstats')))
+
+    def test_profile_option(self):
+        """Bare "--profile" option selects every section."""
+        command = Command()
+        command.load_configuration = lambda: None
+        command.parse_shell_args(['--profile', 'update'])
+        self.assertEqual(command.profile, '*')
+        command.parse_shell_args(['--profile=www,db', 'update'])
+        self.assertEqual(command.profile, 'www,db')
+        command.parse_shell_args(['update', '--profile', '-c', 'other.cfg'])
+        self.assertEqual(command.profile, '*')
+        # Sections must be given as "--profile=SECTION,...".
+        self.assertRaises(SystemExit, command.parse_shell_args,
+                          ['--profile', 'www', 'update'])
+
+
+def describe(recipe):
+    """Return recipe tree as nested tuples, for comparisons."""
+    return (recipe.__class__, recipe.name, recipe.path,
+            sorted(recipe.options.items()),
+            [describe(requirement) for requirement in recipe.requirements],
+            [describe(part) for part in recipe.parts])
+
+
+class FastConfigReaderTestCase(TestCase):
+    """Test novapost.cookbot.settings.FastConfigReader."""
+    def assertSameTree(self, contents):
+        trees = []
+        for reader_class in (ConfigParserReader, FastConfigReader):
+            reader = reader_class(StringIO(contents))
+            trees.append(describe(reader.parse()))
+        self.assertEqual(trees[0], trees[1])
+
+    def test_same_tree(self):
+        """FastConfigReader builds the same tree as ConfigParserReader."""
+        self.assertSameTree(CONFIGURATION)
+        self.assertSameTree(EXECUTION_ORDER_CONFIGURATION)
+
+    def test_syntax(self):
+        """Defaults, interpolation, comments and continuations."""
+        self.assertSameTree("""
+[DEFAULT]
+user = me
+home = /home/%(user)s
+
+; Comment.
+rem Comment.
+[main]
+Parts: a  ; Comment.
+       b
+empty = ""
+path = %(home)s/%(__name__)s
+percent = 100%%
+[a]
+user = you
+requires = b
+[b]
+semicolon = a;b
+""")
+
+    def test_errors(self):
+        """Same errors as ConfigParser."""
+        for (contents, error) in [
+                ('option = value', MissingSectionHeaderError),
+                ('[main]\nnot an option', ParsingError),
+                ('[main]\n=a: b', ParsingError),
+                ('[main]\npath = %(missing)s',
+                 InterpolationMissingOptionError),
+                ('[main]\nparts = other', NoSectionError)]:
+            for reader_class in (ConfigParserReader, FastConfigReader):
+                reader = reader_class(StringIO(contents))
+                self.assertRaises(error, reader.parse)
+
+
+LAZY_MODULE = """
+from novapost.cookbot.recipes import Recipe
+
+
+class LazyTrackerRecipe(Recipe):
+    executed = []
+
+    def update(self):
+        self.executed.append(self.path)
+"""
+
+
+class RegistryTestCase(TestCase):
+    """Test novapost.cookbot.registry."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory,
+                               'cookbot_lazy_recipes.py'), 'w') as module:
+            module.write(LAZY_MODULE)
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop('cookbot_lazy_recipes', None)
+        shutil.rmtree(self.directory)
+
+    def test_resolve_once(self):
+        """Factory strings are resolved once, names can be registered."""
+        registry = FactoryRegistry()
+        factory = registry.resolve('novapost.cookbot.recipes:MachineRecipe')
+        self.assertTrue(factory is MachineRecipe)
+        self.assertTrue(registry.factories[
+            'novapost.cookbot.recipes:MachineRecipe'] is MachineRecipe)
+        registry.register('tracker', TrackerRecipe)
+        self.assertTrue(registry.resolve('tracker') is TrackerRecipe)
+        registry.entry_points = {}
+        self.assertRaises(ImportError, registry.resolve, 'unknown')
+        registry.forget(MachineRecipe.__module__)
+        self.assertEqual(registry.factories.keys(), ['tracker'])
+
+    def test_lazy(self):
+        """Lazy readers import recipe modules when recipes are used."""
+        reader = FastConfigReader(StringIO("""
+[main]
+parts = www
+[www]
+recipe = cookbot_lazy_recipes:LazyTrackerRecipe
+"""), registry=FactoryRegistry(), lazy=True)
+        recipe = reader.parse()
+        self.assertTrue(isinstance(recipe, LazyRecipe))
+        self.assertEqual(recipe.parts[0].path, 'main/www')
+        self.assertFalse('cookbot_lazy_recipes' in sys.modules)
+        recipe.execute(Context(), 'update')
+        self.assertTrue('cookbot_lazy_recipes' in sys.modules)
+        www = recipe.parts[0].materialize()
+        self.assertEqual(www.__class__.__name__, 'LazyTrackerRecipe')
+        self.assertEqual(www.executed, ['main/www'])
+        self.assertEqual(www.path, 'main/www')
+
+    def test_lazy_context(self):
+        """Lazy recipes use the context of each run."""
+        reader = FastConfigReader(StringIO(TEARDOWN_CONFIGURATION),
+                                  registry=FactoryRegistry(), lazy=True)
+        recipe = reader.parse()
+        for run in range(2):
+            context = Context()
+            context['testing'] = []
+            ReverseExecutor(jobs=1).execute(recipe, context, 'uninstall')
+            self.assertEqual([item for item in context['testing']
+                              if item.startswith('Uninstall')],
+                             ['Uninstallb', 'Uninstalla1', 'Uninstalla',
+                              'Uninstallshared', 'Uninstallmain',
+                              'Uninstallbase'])
+            self.assertTrue(recipe.context is context)
+
+    def test_lazy_option(self):
+        """--lazy option makes the command use lazy recipes."""
+        command = Command()
+        command.load_configuration = lambda: None
+        command.parse_shell_args(['--lazy', 'update'])
+        self.assertTrue(command.lazy)
+
+
+class DryRunTestCase(TestCase):
+    """Test novapost.cookbot.dryrun."""
+    def test_steps(self):
+        """Dry run records commands, with context, without running them."""
+        recipe = parse_configuration(EXECUTION_ORDER_CONFIGURATION)
+        recipe.parts[0].is_installed = lambda: True
+        context = Context()
+        context['testing'] = []
+        context['user'] = 'me'
+        dry_run = DryRun()
+        steps = dry_run.execute(recipe, context, ['install', 'uninstall'])
+        self.assertEqual(len(steps), 20)
+        self.assertFalse([item for item in context['testing']
+                          if item.startswith('Install')])
+        self.assertTrue('EnterPart0' in context['testing'])
+        self.assertFalse('dry_run' in context)
+        statuses = [(step.path, step.command, step.status) for step in steps]
+        self.assertEqual(statuses[:3], [('main/Part0', 'install', 'run'),
+                                        ('main/Part0', 'uninstall', 'run'),
+                                        ('main', 'install', 'run')])
+        # Install runs even if the recipe is already installed.
+        self.assertTrue(('main/Part3', 'install', 'run') in statuses)
+        self.assertEqual(steps[0].context['user'], 'me')
+
+    def test_estimates(self):
+        """Total and critical path are estimated from durations."""
+        recipe = parse_configuration(EXECUTION_ORDER_CONFIGURATION)
+        paths = [node.path for node in walk(recipe)]
+        dry_run = DryRun(dict(((path, 'update'), 1.) for path in paths))
+        context = Context()
+        context['testing'] = []
+        dry_run.execute(recipe, context, 'update')
+        self.assertEqual(dry_run.total(), 10.)
+        self.assertEqual(dry_run.critical_path(recipe), 5.)
+        output = StringIO()
+        dry_run.report(output, recipe)
+        self.assertTrue('Estimated duration: 10.00s, critical path: 5.00s.'
+                        in output.getvalue())
+
+
+class TeardownRecipe(TrackerRecipe):
+    """A recipe which tracks uninstall() calls."""
+    def uninstall(self):
+        time.sleep(0.01)
+        self.context['testing'].append('Uninstall%s' % self.name)
+
+
+class SlowTeardownRecipe(TeardownRecipe):
+    """A recipe whose uninstall() takes a while."""
+    def uninstall(self):
+        time.sleep(0.2)
+        super(SlowTeardownRecipe, self).uninstall()
+
+
+class FailingTeardownRecipe(TeardownRecipe):
+    """A recipe whose uninstall() fails."""
+    def uninstall(self):
+        raise Exception('Cannot uninstall %s.' % self.name)
+
+
+class DatabaseConfigurationRecipe(TeardownRecipe):
+    """A recipe which sets "db_host" in context."""
+    def enter_context(self):
+        super(DatabaseConfigurationRecipe, self).enter_context()
+        self.context.push('db_host')
+        self.context['db_host'] = 'db1'
+
+    def exit_context(self):
+        super(DatabaseConfigurationRecipe, self).exit_context()
+        self.context.pop('db_host')
+
+
+class ContextProbeRecipe(TeardownRecipe):
+    """A recipe which records "db_host" context value on uninstall."""
+    seen = {}
+
+    def uninstall(self):
+        self.seen[self.path] = self.context.get('db_host')
+        super(ContextProbeRecipe, self).uninstall()
+
+
+TEARDOWN_CONFIGURATION = """
+[DEFAULT]
+recipe = novapost.cookbot.tests:TeardownRecipe
+
+[main]
+requires = base
+parts =
+    a
+    b
+
+[a]
+requires = shared
+parts = a1
+
+[b]
+requires = shared
+
+[a1]
+[shared]
+[base]
+"""
+
+
+class ReverseExecutorTestCase(TestCase):
+    """Test novapost.cookbot.reverse.ReverseExecutor."""
+    def teardown(self, contents, **kwargs):
+        """Run uninstall, return list of uninstalled recipes."""
+        recipe = parse_configuration(contents)
+        context = Context()
+        context['testing'] = []
+        try:
+            ReverseExecutor(**kwargs).execute(recipe, context, 'uninstall')
+        finally:
+            self.uninstalled = [item[len('Uninstall'):]
+                                for item in context['testing']
+                                if item.startswith('Uninstall')]
+            self.entered = context['testing'].count('Entershared')
+            self.exited = context['testing'].count('Exitshared')
+
+    def test_order(self):
+        """Parts, then recipe, then requirements."""
+        self.teardown(TEARDOWN_CONFIGURATION, jobs=1)
+        self.assertEqual(self.uninstalled,
+                         ['b', 'a1', 'a', 'shared', 'main', 'base'])
+        self.assertEqual(self.entered, 2)
+        self.assertEqual(self.exited, 2)
+
+    def test_parallel(self):
+        """Shared requirements are torn down after every dependent."""
+        self.teardown(TEARDOWN_CONFIGURATION, jobs=4)
+        self.assertEqual(sorted(self.uninstalled),
+                         ['a', 'a1', 'b', 'base', 'main', 'shared'])
+        self.assertEqual(self.uninstalled[-3:], ['shared', 'main', 'base'])
+        self.assertTrue(self.uninstalled.index('a1')
+                        < self.uninstalled.index('a'))
+
+    def test_shared_copies(self):
+        """Any copy of a shared requirement can be torn down."""
+        contents = """
+[DEFAULT]
+recipe = novapost.cookbot.tests:TeardownRecipe
+
+[main]
+parts =
+    a
+    b
+
+[a]
+requires = db
+
+[b]
+recipe = novapost.cookbot.tests:SlowTeardownRecipe
+requires = db
+
+[db]
+parts = pg
+
+[pg]
+requires = lib
+
+[lib]
+"""
+        # "b" finishes last, so its copy of "db" is torn down, whereas "a"
+        # comes first in the tree.
+        self.teardown(contents, jobs=4)
+        self.assertEqual(self.uninstalled,
+                         ['a', 'b', 'pg', 'lib', 'db', 'main'])
+
+    def test_errors(self):
+        """Failures are collected, dependencies are kept."""
+        contents = TEARDOWN_CONFIGURATION.replace(
+            '[b]', '[b]\nrecipe = novapost.cookbot.tests:FailingTeardownRecipe')
+        try:
+            self.teardown(contents, jobs=1)
+        except TeardownError, e:
+            self.assertEqual([path for (path, error) in e.errors], ['main/b'])
+        else:
+            self.fail('TeardownError not raised.')
+        self.assertEqual(self.uninstalled, ['a1', 'a'])
+        self.assertEqual(self.exited, 2)
+        self.assertRaises(TeardownError, self.teardown, contents, jobs=1,
+                          fail_fast=True)
+        self.assertEqual(self.uninstalled, [])
+
+    def test_context(self):
+        """Commands see the same context as in forward execution."""
+        contents = """
+[DEFAULT]
+recipe = novapost.cookbot.tests:ContextProbeRecipe
+
+[main]
+requires = infra
+parts = app
+
+[infra]
+recipe = novapost.cookbot.tests:TeardownRecipe
+parts = dbconf
+
+[dbconf]
+recipe = novapost.cookbot.tests:DatabaseConfigurationRecipe
+
+[app]
+"""
+        ContextProbeRecipe.seen = {}
+        recipe = parse_configuration(contents)
+        context = Context()
+        context['testing'] = []
+        recipe.execute(context, 'uninstall')
+        forward = ContextProbeRecipe.seen
+        self.assertEqual(forward['main/app'], 'db1')
+        ContextProbeRecipe.seen = {}
+        self.teardown(contents, jobs=1)
+        self.assertEqual(ContextProbeRecipe.seen, forward)
+        self.assertEqual(self.uninstalled,
+                         ['app', 'main', 'dbconf', 'infra'])
+
+    def test_selection(self):
+        """Shared requirements are kept while a dependent is installed."""
+        recipe = parse_configuration(TEARDOWN_CONFIGURATION)
+        context = Context()
+        context['testing'] = []
+        ReverseExecutor(jobs=1).execute(recipe, context, 'uninstall',
+                                        selection=Selection(['main/a']))
+        self.assertEqual([item for item in context['testing']
+                          if item.startswith('Uninstall')],
+                         ['Uninstalla1', 'Uninstalla'])
+        self.assertEqual(context['testing'].count('Entershared'),
+                         context['testing'].count('Exitshared'))
+
+    def test_options(self):
+        """Reverse commands cannot be mixed with forward ones."""
+        command = Command()
+        command.load_configuration = lambda: None
+        command.parse_shell_args(['--jobs=2', '--fail-fast', 'uninstall'])
+        self.assertEqual((command.jobs, command.fail_fast), (2, True))
+        self.assertTrue(command.is_reverse())
+        self.assertRaises(SystemExit, command.parse_shell_args,
+                          ['install,uninstall'])
+
+
+class LockManagerTestCase(TestCase):
+    """Test novapost.cookbot.locks.LockManager."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_overlap(self):
+        """Descendants wait for ancestors, siblings do not wait."""
+        locks = LockManager(os.path.join(self.directory, 'locks'))
+        with locks.lock('main/a'):
+            with locks.lock('main/b'):
+                self.assertEqual(locks.stats()['contentions'], 0)
+        lock = locks.lock('main')
+        lock.acquire()
+        thread = threading.Thread(
+            target=lambda: locks.release(locks.acquire('main/a')[0]))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(locks.stats()['acquisitions'], 3)
+        lock.release()
+        thread.join()
+        stats = locks.stats()
+        self.assertEqual((stats['acquisitions'], stats['contentions']),
+                         (4, 1))
+        self.assertTrue(stats['wait_max'] > 0.05)
+
+    def test_commands(self):
+        """Commands lock their recipe."""
+        recipe = parse_configuration(CONFIGURATION)
+        context = Context()
+        context['locks'] = LockManager(self.directory)
+        recipe.execute(context, 'update')
+        self.assertEqual(context['locks'].stats()['acquisitions'],
+                         len(list(walk(recipe))))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, 'main%2Fdev%2Fdev-machine.lock')))
+
+
+class StatusRecipe(Recipe):
+    """A recipe with a cacheable "status" command."""
+    calls = []
+
+    def __init__(self, context, name, options):
+        super(StatusRecipe, self).__init__(context, name, options)
+        self.expose('status', cacheable=True, ttl=float(options['ttl']),
+                    reads=['release'])
+
+    def status(self):
+        self.calls.append(self.name)
+        return {'home': self.options['home']}
+
+
+class ResultCacheTestCase(TestCase):
+    """Test novapost.cookbot.cache.ResultCache."""
+    def setUp(self):
+        StatusRecipe.calls = []
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_commands(self):
+        """Results are cached per options and context values."""
+        recipe = parse_configuration("""
+[main]
+recipe = novapost.cookbot.tests:StatusRecipe
+home = /home/${user}
+ttl = 0.2
+""")
+        context = Context()
+        context['cache'] = ResultCache()
+        context['user'] = 'me'
+        for user, release in [('me', 1), ('me', 1), ('you', 1), ('me', 2),
+                              ('me', 2)]:
+            context['user'] = user
+            context['release'] = release
+            recipe.execute(context, 'status')
+        self.assertEqual(len(StatusRecipe.calls), 3)
+        self.assertEqual(recipe.invoke('status'), {'home': '/home/me'})
+        self.assertEqual(len(StatusRecipe.calls), 3)
+        time.sleep(0.25)
+        recipe.execute(context, 'status')
+        self.assertEqual(len(StatusRecipe.calls), 4)
+        self.assertFalse('status' in Recipe.default_cache_policies)
+
+    def test_lookups(self):
+        """Keys depend on values looked up by templates."""
+        recipe = parse_configuration("""
+[main]
+recipe = novapost.cookbot.recipes:MachineRecipe
+host = ${h}
+port = 22
+parts = status
+
+[status]
+recipe = novapost.cookbot.tests:StatusRecipe
+home = /home/${machine.host}
+ttl = 60
+""")
+        context = Context()
+        context['cache'] = ResultCache()
+        context['testing'] = []
+        for host in ('a.example', 'b.example', 'a.example'):
+            context['h'] = host
+            recipe.execute(context, 'status')
+        # "a.example" result is reused, "b.example" is not.
+        self.assertEqual(len(StatusRecipe.calls), 2)
+
+    def test_eviction(self):
+        """Least recently used results are evicted."""
+        cache = ResultCache(max_size=200)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, 'x' * 80)
+            cache.get('a')
+        self.assertEqual(cache.entries.keys(), ['c', 'a'])
+        self.assertEqual(cache.get('b'), (False, None))
+        cache.set('big', 'x' * 300)
+        self.assertEqual(cache.get('big'), (False, None))
+
+    def test_disk(self):
+        """Results survive runs in a directory."""
+        ResultCache(self.directory).set('key', [1, 2])
+        cache = ResultCache(self.directory)
+        self.assertEqual(cache.get('key'), (True, [1, 2]))
+        cache.set('expired', 'value', ttl=-1)
+        self.assertEqual(ResultCache(self.directory).get('expired'),
+                         (False, None))
+        self.assertEqual(os.listdir(self.directory), ['key'])
+
+    def test_private_directory(self):
+        """Only files private to the current user are unpickled."""
+        ResultCache(self.directory).set('key', [1, 2])
+        path = os.path.join(self.directory, 'key')
+        os.chmod(path, 0620)
+        self.assertEqual(ResultCache(self.directory).get('key'),
+                         (False, None))
+        os.chmod(path, 0600)
+        os.chmod(self.directory, 0777)
+        self.assertEqual(ResultCache(self.directory).get('key'),
+                         (False, None))
+        ResultCache(self.directory).set('other', 1)
+        self.assertFalse('other' in os.listdir(self.directory))
+        os.chmod(self.directory, 0700)
+        self.assertEqual(ResultCache(self.directory).get('key'),
+                         (True, [1, 2]))
+
+    def test_command(self):
+        """The command keeps its cache across runs."""
+        command = Command()
+        self.assertTrue(command.get_context()['cache']
+                        is command.get_context()['cache'])
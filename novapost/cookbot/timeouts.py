@@ -0,0 +1,191 @@
+"""Interrupt recipe commands which exceed their timeout."""
+import ctypes
+import sys
+import thread
+import threading
+import time
+import traceback
+
+
+class RecipeTimeout(Exception):
+    """Raised when a recipe's command exceeds its timeout."""
+    def __init__(self, recipe_name=None, cmd=None, timeout=None, stack=None):
+        """Constructor.
+
+        Arguments are optional because the watchdog raises the exception
+        class asynchronously in the hung thread. The guard then raises a
+        complete instance.
+
+        """
+        if recipe_name is None:
+            message = 'Command exceeded its timeout.'
+        else:
+            message = 'Command %r of recipe %r exceeded its timeout (%ss).' \
+                      % (cmd, recipe_name, timeout)
+        super(RecipeTimeout, self).__init__(message)
+        self.recipe_name = recipe_name
+        self.cmd = cmd
+        self.timeout = timeout
+        self.stack = stack  # Stack of the hung thread, as a string.
+
+
+def raise_in_thread(thread_id, exception_class):
+    """Asynchronously raise ``exception_class`` in thread. If
+    ``exception_class`` is None, cancel pending asynchronous exception.
+
+    The exception is raised when the thread executes Python code again, i.e.
+    blocking system calls are not interrupted.
+
+    """
+    if exception_class is not None:
+        exception_class = ctypes.py_object(exception_class)
+    count = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread_id), exception_class)
+    if count > 1:  # Should not happen. Revert.
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread_id),
+                                                   None)
+        count = 0
+    return count
+
+
+class Guard(object):
+    """Context manager which arms the watchdog for a command call."""
+    def __init__(self, watchdog, recipe, cmd, timeout):
+        """Constructor."""
+        self.watchdog = watchdog
+        self.recipe = recipe
+        self.cmd = cmd
+        self.timeout = timeout
+        self.thread_id = thread.get_ident()
+        self.deadline = None
+        self.fired = False
+        self.exited = threading.Event()  # Set when the guarded call exits.
+        self.done = threading.Event()  # Set once the watchdog has fired.
+        self.stack = None
+
+    def __enter__(self):
+        self.watchdog.arm(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.watchdog.disarm(self)
+        if self.fired:
+            try:
+                self.done.wait()
+                # Command returned while the watchdog was firing.
+                raise_in_thread(self.thread_id, None)
+            except RecipeTimeout:
+                pass
+            raise RecipeTimeout(self.recipe.name, self.cmd, self.timeout,
+                                self.stack)
+
+
+class Watchdog(object):
+    """Thread which watches guarded command calls.
+
+    When a call exceeds its timeout, the watchdog:
+
+    * writes a dump of the hung thread's stack to ``stream``;
+
+    * calls recipe's ``interrupt()`` method, so that the recipe has a chance
+      to clean up, e.g. kill subprocesses. If ``interrupt()`` returns True,
+      i.e. it cancelled the command, the call is given ``grace`` seconds to
+      exit by itself;
+
+    * raises :py:class:`RecipeTimeout` in the hung thread.
+
+    Guarded calls raise :py:class:`RecipeTimeout` once fired, whatever the
+    way they exit.
+
+    A single thread watches every guard, whatever the number of threads
+    running commands.
+
+    """
+    def __init__(self, stream=None, grace=1.):
+        """Constructor."""
+        self.stream = stream  # Defaults to sys.stderr.
+        self.grace = grace
+        self.condition = threading.Condition()
+        self.guards = []
+        self.thread = None
+
+    def guard(self, recipe, cmd, timeout):
+        """Return context manager which interrupts the code it wraps after
+        ``timeout`` seconds."""
+        return Guard(self, recipe, cmd, timeout)
+
+    def arm(self, guard):
+        """Start watching guard."""
+        with self.condition:
+            guard.deadline = time.time() + guard.timeout
+            self.guards.append(guard)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='cookbot-watchdog')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def disarm(self, guard):
+        """Stop watching guard."""
+        with self.condition:
+            try:
+                self.guards.remove(guard)
+            except ValueError:  # Already fired.
+                pass
+        guard.exited.set()
+
+    def run(self):
+        """Watchdog thread's main loop. Guards are fired without holding the
+        lock, so that commands can be cancelled while other guards are armed
+        or disarmed."""
+        while True:
+            expired = self.wait_expired()
+            cancelled = [guard for guard in expired if self.fire(guard)]
+            deadline = time.time() + self.grace
+            for guard in expired:
+                if guard in cancelled:
+                    guard.exited.wait(max(deadline - time.time(), 0))
+                if not guard.exited.is_set():
+                    raise_in_thread(guard.thread_id, RecipeTimeout)
+                guard.done.set()
+
+    def wait_expired(self):
+        """Block until some guards expire. Stop watching them, mark them as
+        fired and return them."""
+        with self.condition:
+            while True:
+                now = time.time()
+                expired = [guard for guard in self.guards
+                           if guard.deadline <= now]
+                if expired:
+                    for guard in expired:
+                        self.guards.remove(guard)
+                        guard.fired = True
+                    return expired
+                if self.guards:
+                    next_deadline = min(guard.deadline for guard in self.guards)
+                    self.condition.wait(max(next_deadline - now, 0.001))
+                else:
+                    self.condition.wait()
+
+    def fire(self, guard):
+        """Report guarded call and let recipe interrupt it. Return True if the
+        call was cancelled."""
+        frame = sys._current_frames().get(guard.thread_id)
+        if frame is not None:
+            guard.stack = ''.join(traceback.format_stack(frame))
+        stream = self.stream or sys.stderr
+        stream.write('Command %r of recipe %r exceeded its timeout (%ss).\n'
+                     % (guard.cmd, guard.recipe.name, guard.timeout))
+        if guard.stack:
+            stream.write(guard.stack)
+        try:
+            return bool(guard.recipe.interrupt(guard.cmd, guard.thread_id))
+        except Exception:
+            traceback.print_exc(file=stream)
+            return False
+
+
+#: Watchdog used by recipes.
+watchdog = Watchdog()
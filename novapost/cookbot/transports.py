@@ -0,0 +1,335 @@
+"""Run commands on machines, locally or through persistent sessions.
+
+Machine recipes (see :py:class:`~novapost.cookbot.recipes.MachineRecipe`)
+push a transport in context, as "transport". Recipes run commands with it:
+
+.. code-block:: python
+
+    class NginxRecipe(Recipe):
+        def update(self):
+            self.context['transport'].run(['service', 'nginx', 'reload'],
+                                          check=True)
+
+Sessions are persistent connections to a host. They are pooled: every recipe
+under a machine reuses the same sessions, and the number of sessions open on a
+host is capped.
+
+.. warning::
+
+   :py:class:`Session` is only a skeleton of a pooled session: it speaks a
+   plain JSON protocol, without authentication nor encryption, to a
+   compatible server. Use it on trusted networks only, or give
+   :py:class:`SessionPool` a ``connect`` factory of sessions over a secure
+   transport, such as an SSH ControlMaster connection.
+
+"""
+import json
+import socket
+import subprocess
+import thread
+import threading
+import time
+
+
+class TransportError(Exception):
+    """Raised when a command cannot be run."""
+
+
+class CommandError(TransportError):
+    """Raised when a command exits with non-zero status."""
+    def __init__(self, command, result):
+        """Constructor."""
+        super(CommandError, self).__init__(
+            'Command %r exited with status %d.' % (command, result.returncode))
+        self.command = command
+        self.result = result
+
+
+class CommandResult(object):
+    """Status and output of a command."""
+    __slots__ = ('returncode', 'stdout', 'stderr')
+
+    def __init__(self, returncode, stdout='', stderr=''):
+        """Constructor."""
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__, self.returncode,
+                                   self.stdout, self.stderr)
+
+
+class Transport(object):
+    """Base class for transports."""
+    def run(self, command, input=None, check=False):
+        """Run command and return :py:class:`CommandResult`.
+
+        ``command`` is either a list of arguments or a shell command line.
+        ``input`` is sent to command's standard input.
+
+        If ``check`` is True, raise :py:class:`CommandError` if command exits
+        with non-zero status.
+
+        """
+        result = self.execute(command, input)
+        if check and result.returncode != 0:
+            raise CommandError(command, result)
+        return result
+
+    def execute(self, command, input=None):
+        """Run command and return :py:class:`CommandResult`. Override this."""
+        raise NotImplementedError()
+
+    def cancel(self, thread_id):
+        """Cancel command run by thread ``thread_id``, if any, e.g. when it
+        exceeds its timeout. Called from another thread.
+
+        Return True if a command was cancelled: it then raises
+        :py:class:`TransportError` in its thread.
+
+        """
+        return False
+
+    def close(self):
+        """Release resources held by transport."""
+
+
+def start_subprocess(command):
+    """Return :py:class:`subprocess.Popen` running command, with pipes."""
+    shell = isinstance(command, basestring)
+    return subprocess.Popen(command, shell=shell, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def run_subprocess(command, input=None):
+    """Run command in a subprocess and return :py:class:`CommandResult`."""
+    process = start_subprocess(command)
+    (stdout, stderr) = process.communicate(input)
+    return CommandResult(process.returncode, stdout, stderr)
+
+
+class LocalTransport(Transport):
+    """Run commands in local subprocesses. Cancelled commands are killed."""
+    def __init__(self):
+        """Constructor."""
+        self.processes = {}  # Running process, per thread.
+        self.lock = threading.Lock()
+
+    def execute(self, command, input=None):
+        process = start_subprocess(command)
+        thread_id = thread.get_ident()
+        with self.lock:
+            self.processes[thread_id] = process
+        try:
+            (stdout, stderr) = process.communicate(input)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            raise
+        finally:
+            with self.lock:
+                cancelled = self.processes.pop(thread_id, None) is None
+        if cancelled:
+            raise TransportError('Command %r was cancelled.' % (command,))
+        return CommandResult(process.returncode, stdout, stderr)
+
+    def cancel(self, thread_id):
+        with self.lock:
+            process = self.processes.pop(thread_id, None)
+        if process is None:
+            return False
+        try:
+            process.kill()
+        except OSError:  # Already exited.
+            pass
+        return True
+
+
+#: Default timeout of session sockets, in seconds.
+DEFAULT_SESSION_TIMEOUT = 300.
+
+
+class Session(object):
+    """Persistent connection to a host, skeleton for :py:class:`SessionPool`.
+
+    Requests and responses are JSON documents, one per line. There is no
+    authentication nor encryption, see warning above.
+
+    """
+    def __init__(self, host, port, timeout=DEFAULT_SESSION_TIMEOUT):
+        """Constructor.
+
+        ``timeout`` is the timeout of socket operations, in seconds: connection
+        and each command. None means no timeout.
+
+        """
+        self.host = host
+        self.port = port
+        try:
+            self.socket = socket.create_connection((host, port), timeout)
+        except socket.error, e:
+            raise TransportError('Cannot connect to %s:%s: %s'
+                                 % (host, port, e))
+        self.file = self.socket.makefile('rwb')
+
+    def execute(self, command, input=None):
+        """Run command on remote host and return :py:class:`CommandResult`."""
+        try:
+            self.file.write(json.dumps({'command': command, 'input': input}))
+            self.file.write('\n')
+            self.file.flush()
+            response = self.file.readline()
+            if not response:
+                raise TransportError('Connection closed by %s:%s.'
+                                     % (self.host, self.port))
+            response = json.loads(response)
+        except (socket.error, ValueError), e:
+            raise TransportError('Session with %s:%s failed: %s'
+                                 % (self.host, self.port, e))
+        return CommandResult(response['returncode'], response['stdout'],
+                             response['stderr'])
+
+    def cancel(self):
+        """Shut connection down, so that a pending command fails at once.
+        Called from another thread."""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        """Close connection."""
+        try:
+            self.file.close()
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class SessionPool(object):
+    """Pool of persistent sessions, with a cap on open sessions per host."""
+    def __init__(self, connect=Session, max_sessions=4):
+        """Constructor.
+
+        ``connect(host, port)`` is the factory of sessions.
+
+        ``max_sessions`` is the default maximum number of sessions open on a
+        host. See :py:meth:`set_limit`.
+
+        """
+        self.connect = connect
+        self.max_sessions = max_sessions
+        self.condition = threading.Condition()
+        self.limits = {}  # Maximum number of sessions, per host.
+        self.open = {}  # Number of open sessions, per host.
+        self.idle = {}  # List of idle sessions, per (host, port).
+
+    def set_limit(self, host, max_sessions):
+        """Set maximum number of sessions open on host."""
+        with self.condition:
+            self.limits[host] = max_sessions
+            self.condition.notify_all()
+
+    def acquire(self, host, port, timeout=None):
+        """Return a session to host. Reuse idle sessions if possible.
+
+        Waits for a session to be released if the host's limit is reached.
+        Raises :py:class:`TransportError` if ``timeout`` (in seconds) expires
+        before.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                idle = self.idle.get((host, port))
+                if idle:
+                    return idle.pop()
+                limit = self.limits.get(host, self.max_sessions)
+                if self.open.get(host, 0) < limit:
+                    self.open[host] = self.open.get(host, 0) + 1
+                    break
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TransportError('Too many sessions open on %s.'
+                                             % host)
+                    self.condition.wait(remaining)
+        try:
+            return self.connect(host, port)
+        except Exception:
+            self.discard(host)
+            raise
+
+    def release(self, session, broken=False):
+        """Give session back to the pool. Broken sessions are closed."""
+        if broken:
+            session.close()
+            self.discard(session.host)
+            return
+        with self.condition:
+            self.idle.setdefault((session.host, session.port), []) \
+                .append(session)
+            self.condition.notify()
+
+    def discard(self, host):
+        """Forget a session of host, which has been closed."""
+        with self.condition:
+            self.open[host] -= 1
+            self.condition.notify()
+
+    def close(self):
+        """Close idle sessions."""
+        with self.condition:
+            for sessions in self.idle.values():
+                for session in sessions:
+                    session.close()
+                    self.open[session.host] -= 1
+            self.idle = {}
+            self.condition.notify_all()
+
+
+class PooledTransport(Transport):
+    """Run commands through sessions of a :py:class:`SessionPool`.
+
+    Cancelled commands break their session, which is closed.
+
+    """
+    def __init__(self, pool, host, port):
+        """Constructor."""
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.sessions = {}  # Session in use, per thread.
+        self.lock = threading.Lock()
+
+    def execute(self, command, input=None):
+        session = self.pool.acquire(self.host, self.port)
+        thread_id = thread.get_ident()
+        with self.lock:
+            self.sessions[thread_id] = session
+        try:
+            result = session.execute(command, input)
+        except Exception:  # E.g. cancelled, or interrupted by a timeout.
+            self.pool.release(session, broken=True)
+            raise
+        finally:
+            with self.lock:
+                del self.sessions[thread_id]
+        self.pool.release(session)
+        return result
+
+    def cancel(self, thread_id):
+        with self.lock:
+            session = self.sessions.get(thread_id)
+        if session is None:
+            return False
+        session.cancel()
+        return True
+
+
+#: Session pool used when context provides none.
+session_pool = SessionPool()
@@ -0,0 +1,195 @@
+"""Watch configuration and recipe modules, re-run commands on changes.
+
+Implementation of ``cookbot watch <command>``. Configuration file and source
+files of recipe modules are polled. When they change, the command runs again,
+only on recipes whose section (or recipe module) changed, and on recipes which
+require them. Changes arriving in bursts, e.g. when saving several files, are
+debounced into one run.
+
+"""
+import os
+import sys
+import time
+import traceback
+
+from registry import registry
+from selection import Selection, walk
+from settings import DEFAULT_RECIPE
+
+
+def file_state(path):
+    """Return (mtime, size) of file, or None if file does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def module_file(module_name):
+    """Return path to source file of module, or None."""
+    module = sys.modules.get(module_name)
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return os.path.abspath(path)
+
+
+def factory_module(options):
+    """Return name of module which provides recipe factory of section."""
+    factory_string = options.get('recipe', DEFAULT_RECIPE)
+    if ':' in factory_string:
+        return factory_string.split(':')[0]
+    return registry.resolve(factory_string).__module__
+
+
+def changed_sections(old_sections, new_sections):
+    """Return names of sections added or modified in ``new_sections``.
+
+    >>> sorted(changed_sections({'a': {'x': '1'}, 'b': {}},
+    ...                         {'a': {'x': '2'}, 'b': {}, 'c': {}}))
+    ['a', 'c']
+
+    """
+    return set(name for name, options in new_sections.items()
+               if old_sections.get(name) != options)
+
+
+def with_dependents(sections, names):
+    """Return names and names of sections which require them, recursively.
+
+    >>> sections = {'www': {'requires': 'db'}, 'db': {'requires': 'disk'},
+    ...             'disk': {}, 'media': {}}
+    >>> sorted(with_dependents(sections, ['disk']))
+    ['db', 'disk', 'www']
+
+    """
+    dependents = {}
+    for name, options in sections.items():
+        for requirement in options.get('requires', '').split():
+            dependents.setdefault(requirement, set()).add(name)
+    result = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in result:
+            result.add(name)
+            pending.extend(dependents.get(name, ()))
+    return result
+
+
+class Watcher(object):
+    """Re-run command's recipes when their configuration or module changes."""
+    def __init__(self, command, interval=1., debounce=0.5, stream=None):
+        """Constructor.
+
+        ``command`` is a :py:class:`~novapost.cookbot.command.Command`, with
+        shell arguments already parsed.
+
+        Files are polled every ``interval`` seconds. Once a change is
+        detected, the watcher waits until files are left unchanged for
+        ``debounce`` seconds.
+
+        """
+        self.command = command
+        self.interval = interval
+        self.debounce = debounce
+        self.stream = stream  # Defaults to sys.stderr.
+        self.sections = {}  # Options per section.
+        self.files = {}  # State per watched file, see file_state().
+        self.load()
+
+    def load(self):
+        """Load configuration, remember state of watched files.
+
+        Recipe factories are resolved, so that modules of lazy recipes are
+        watched too.
+
+        """
+        self.command.load_configuration()
+        self.sections = dict((name, dict(options)) for name, options
+                             in self.command.reader.sections.items())
+        registry.warm_up([options.get('recipe', DEFAULT_RECIPE)
+                          for options in self.sections.values()],
+                         entry_points=False)
+        paths = [os.path.abspath(self.command.cfg)]
+        for options in self.sections.values():
+            path = module_file(factory_module(options))
+            if path is not None:
+                paths.append(path)
+        self.files = dict((path, file_state(path)) for path in paths)
+
+    def poll(self):
+        """Return set of watched files which changed since last poll."""
+        changed = set()
+        for path, state in self.files.items():
+            new_state = file_state(path)
+            if new_state != state:
+                self.files[path] = new_state
+                changed.add(path)
+        return changed
+
+    def check(self):
+        """Poll files, re-run command if some changed. Return set of sections
+        the command ran on, or None if nothing changed."""
+        changed = self.poll()
+        if not changed:
+            return None
+        while self.debounce:
+            time.sleep(self.debounce)
+            more = self.poll()
+            if not more:
+                break
+            changed |= more
+        return self.apply(changed)
+
+    def apply(self, changed_files):
+        """Reload configuration and modules, re-run command on affected
+        sections. Return set of affected sections."""
+        changed_modules = set()
+        for name, module in sys.modules.items():
+            if module is not None and module_file(name) in changed_files:
+                reload(module)
+                registry.forget(name)
+                changed_modules.add(name)
+        old_sections = self.sections
+        self.load()
+        affected = changed_sections(old_sections, self.sections)
+        affected.update(name for name, options in self.sections.items()
+                        if factory_module(options) in changed_modules)
+        affected = with_dependents(self.sections, affected)
+        paths = [recipe.path for recipe in walk(self.command.recipe)
+                 if recipe.name in affected]
+        selected = self.command.selection  # From command's selectors.
+        if selected is not None and paths:
+            changed = Selection(paths)
+            paths = [path for path in paths if selected.covers(path)]
+            paths.extend(path for path in selected.paths
+                         if changed.covers(path))
+        if paths:
+            self.command.selection = Selection(paths)
+            try:
+                self.command()
+            finally:
+                self.command.selection = selected
+        return affected
+
+    def run(self):
+        """Watch forever."""
+        stream = self.stream or sys.stderr
+        stream.write('Watching %s. Press Ctrl+C to stop.\n'
+                     % ', '.join(sorted(self.files)))
+        while True:
+            time.sleep(self.interval)
+            try:
+                affected = self.check()
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                traceback.print_exc(file=stream)
+                continue
+            if affected is not None:
+                stream.write('Applied changes of %s.\n'
+                             % (', '.join(sorted(affected)) or 'nothing'))
@@ -35,5 +35,9 @@ setup(name='novapost.cookbot',
           "console_scripts": [
               "cookbot = novapost.cookbot.command:main"
           ],
+          "novapost.cookbot.recipes": [
+              "recipe = novapost.cookbot.recipes:Recipe",
+              "machine = novapost.cookbot.recipes:MachineRecipe",
+          ],
       },
       )